@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+_backends = {}
+
+
+class EdgeCache(object):
+    """
+    Stores the ids of the statuses of every relationship from one user to
+    another on a given site, using one of the caches configured in
+    ``settings.CACHES``.
+    """
+    def __init__(self, cache, timeout=None, prefix='relationships'):
+        self.cache = cache
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def make_key(self, from_user_id, to_user_id, site_id):
+        return '%s:edges:%s:%s:%s' % (self.prefix, from_user_id, to_user_id, site_id)
+
+    def get_many(self, pairs, site_id):
+        """
+        Returns a dictionary keyed by (from_user_id, to_user_id) containing a
+        tuple of status ids for every pair found in the cache.
+        """
+        keys = dict((self.make_key(f, t, site_id), (f, t)) for f, t in pairs)
+        found = self.cache.get_many(keys.keys())
+        return dict((keys[key], statuses) for key, statuses in found.items())
+
+    def set_many(self, edges, site_id):
+        self.cache.set_many(dict(
+            (self.make_key(f, t, site_id), tuple(statuses))
+            for (f, t), statuses in edges.items()
+        ), self.timeout)
+
+    def delete(self, from_user_id, to_user_id, site_id):
+        self.cache.delete(self.make_key(from_user_id, to_user_id, site_id))
+
+    def delete_many(self, pairs, site_id):
+        self.cache.delete_many([self.make_key(f, t, site_id) for f, t in pairs])
+
+
+def get_edge_cache():
+    """
+    Returns an :class:`EdgeCache` if ``RELATIONSHIPS_CACHE_ALIAS`` names a
+    cache, otherwise ``None`` and relationship lookups go to the database.
+    """
+    alias = getattr(settings, 'RELATIONSHIPS_CACHE_ALIAS', None)
+    if not alias:
+        return None
+
+    if alias not in _backends:
+        _backends[alias] = get_cache(alias)
+
+    return EdgeCache(
+        _backends[alias],
+        getattr(settings, 'RELATIONSHIPS_CACHE_TIMEOUT', 60 * 60),
+        getattr(settings, 'RELATIONSHIPS_CACHE_PREFIX', 'relationships'),
+    )
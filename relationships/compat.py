@@ -16,3 +16,109 @@ try:
     from django.conf.urls import patterns, url, include
 except:
     from django.conf.urls.defaults import patterns, url, include
+
+# StreamingHttpResponse was added in 1.5, before that a plain HttpResponse is
+# given the iterator, which it streams unless a middleware reads the content
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    from django.http import HttpResponse as StreamingHttpResponse
+
+# transaction.on_commit was added in 1.9 and transaction.atomic in 1.6.
+# Before 1.9 the atomic() below wraps Django's atomic, or before 1.6
+# commit_on_success unless a transaction is already being managed (since
+# nesting it would commit the outer transaction).  Functions passed to
+# on_commit() while a transaction is open, whether or not atomic() opened it,
+# are run when the connection really commits and dropped when it rolls back,
+# or rolls back to a savepoint taken before they were registered; outside of
+# a transaction they are run immediately.  in_transaction() tells whether a
+# transaction is open.
+try:
+    from django.db.transaction import atomic, on_commit
+
+    def in_transaction(using=None):
+        from django.db import DEFAULT_DB_ALIAS, connections
+        return connections[using or DEFAULT_DB_ALIAS].in_atomic_block
+except ImportError:
+    from django.db import DEFAULT_DB_ALIAS, connections, transaction
+    from django.utils.functional import wraps
+
+    try:
+        from django.db.transaction import atomic as _atomic
+    except ImportError:
+        _atomic = None
+
+    def _savepoint_level(conn):
+        # Django 1.6 keeps a stack of savepoints, before it atomic() nests
+        # without them
+        return len(getattr(conn, 'savepoint_ids', ()))
+
+    def _hook(conn):
+        # the connection object belongs to this thread, so its commit and
+        # rollback are wrapped to run or drop the functions queued on it
+        if hasattr(conn, '_relationships_pending'):
+            return
+        conn._relationships_pending = []
+        commit, rollback = conn._commit, conn._rollback
+
+        def _commit():
+            result = commit()
+            _run_pending(conn)
+            return result
+
+        def _rollback():
+            conn._relationships_pending = []
+            return rollback()
+
+        conn._commit = _commit
+        conn._rollback = _rollback
+
+    def _run_pending(conn):
+        pending, conn._relationships_pending = conn._relationships_pending, []
+        for level, func in pending:
+            func()
+
+    def in_transaction(using=None):
+        conn = connections[using or DEFAULT_DB_ALIAS]
+        if _atomic is not None:
+            return conn.in_atomic_block
+        return conn.is_managed()
+
+    def _run_atomic(func, using, args, kwargs):
+        if _atomic is not None:
+            return _atomic(using=using)(func)(*args, **kwargs)
+        if transaction.is_managed(using=using):
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(using=using)(func)(*args, **kwargs)
+
+    def atomic(func=None, using=None):
+        if func is None:
+            # used as atomic(using=alias)(func)
+            return lambda func: atomic(func, using)
+
+        def inner(*args, **kwargs):
+            conn = connections[using or DEFAULT_DB_ALIAS]
+            try:
+                result = _run_atomic(func, using, args, kwargs)
+            except:
+                # forget the functions registered after a savepoint which
+                # has been rolled back
+                level = _savepoint_level(conn)
+                conn.__dict__['_relationships_pending'] = [
+                    (l, f) for l, f in conn.__dict__.get('_relationships_pending', [])
+                    if l <= level]
+                raise
+            if conn.__dict__.get('_relationships_pending') and not in_transaction(using):
+                # the transaction ended without a commit, having written
+                # nothing
+                _run_pending(conn)
+            return result
+        return wraps(func)(inner)
+
+    def on_commit(func, using=None):
+        if not in_transaction(using):
+            func()
+            return
+        conn = connections[using or DEFAULT_DB_ALIAS]
+        _hook(conn)
+        conn._relationships_pending.append((_savepoint_level(conn), func))
@@ -0,0 +1,91 @@
+import logging
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+from .compat import on_commit
+from .signals import relationship_event
+
+
+CREATED = 'created'
+DELETED = 'deleted'
+STATUS_CHANGED = 'status_changed'
+EVENT_CHOICES = (
+    (CREATED, 'created'),
+    (DELETED, 'deleted'),
+    (STATUS_CHANGED, 'status changed'),
+)
+
+logger = logging.getLogger('relationships.events')
+
+_backends = {}
+
+
+def deliver(events):
+    """
+    Sends the :data:`relationships.signals.relationship_event` signal for
+    each of the given :class:`RelationshipEvent` objects.
+    """
+    for event in events:
+        relationship_event.send(sender=event.__class__, event=event)
+
+
+class SyncBackend(object):
+    """
+    Delivers events in the process that made the change, once its transaction
+    has been committed.
+    """
+    def enqueue(self, events):
+        on_commit(lambda: deliver(events))
+
+
+class ThreadBackend(object):
+    """
+    Hands events to a pool of ``RELATIONSHIPS_EVENT_THREADS`` worker threads
+    once the transaction has been committed, so receivers do not add to the
+    time taken to respond.
+    """
+    def __init__(self):
+        self.pool = ThreadPool(getattr(settings, 'RELATIONSHIPS_EVENT_THREADS', 4))
+
+    def enqueue(self, events):
+        on_commit(lambda: self.pool.apply_async(self.deliver, (events,)))
+
+    def deliver(self, events):
+        try:
+            deliver(events)
+        except Exception:
+            logger.exception('Error delivering relationship events')
+        finally:
+            # each worker thread has its own database connection
+            connection.close()
+
+
+class QueueBackend(object):
+    """
+    Stores events in the relationship event table as part of the transaction
+    that made the change.  They are delivered by the
+    ``drain_relationship_events`` management command.
+    """
+    def enqueue(self, events):
+        from .models import RelationshipEvent
+        RelationshipEvent.objects.bulk_create(events)
+
+
+def get_event_backend():
+    """
+    Returns the backend named by the ``RELATIONSHIPS_EVENT_BACKEND`` setting,
+    i.e. ``'relationships.events.QueueBackend'``, or ``None`` if relationship
+    events are disabled.
+    """
+    path = getattr(settings, 'RELATIONSHIPS_EVENT_BACKEND', None)
+    if not path:
+        return None
+
+    if path not in _backends:
+        module, attr = path.rsplit('.', 1)
+        _backends[path] = getattr(import_module(module), attr)()
+
+    return _backends[path]
@@ -0,0 +1,205 @@
+import os
+import time
+
+from django.conf import settings
+
+from .models import Relationship, RelationshipChange, RelationshipStatus, _edges_query
+from .sites import get_current_site_id
+from .snapshot import load_snapshot, snapshot_filename
+
+
+# (directory, status id, site id) -> RelationshipGraph
+_graphs = {}
+
+# changed relationships looked up per query
+CHUNK_SIZE = 100
+
+
+class _GraphState(object):
+    """
+    The snapshots a graph answers from along with the relationships added and
+    removed since they were taken.  It is never modified once built, so
+    swapping in a new one is a single assignment.
+    """
+    def __init__(self, forward, reverse, file_id):
+        self.forward = forward
+        self.reverse = reverse
+        self.file_id = file_id
+        self.added_forward = {}
+        self.added_reverse = {}
+        self.removed_forward = {}
+        self.removed_reverse = {}
+
+    def _add(self, edges, forward, reverse):
+        for from_user_id, to_user_id in edges:
+            forward.setdefault(from_user_id, set()).add(to_user_id)
+            reverse.setdefault(to_user_id, set()).add(from_user_id)
+
+    def load_delta(self):
+        status_id, site_id = self.forward.status_id, self.forward.site_id
+        watermark = min(self.forward.watermark, self.reverse.watermark)
+        self._add(Relationship.objects.filter(
+            status=status_id,
+            site=site_id,
+            created__gte=watermark,
+        ).values_list('from_user', 'to_user'), self.added_forward, self.added_reverse)
+
+        # relationships deleted or changing status since the snapshots were
+        # taken are looked up again to find whether they still exist
+        changed = list(set(RelationshipChange.objects.filter(
+            status_id=status_id,
+            site_id=site_id,
+            changed__gte=watermark,
+        ).values_list('from_user_id', 'to_user_id')))
+        for i in range(0, len(changed), CHUNK_SIZE):
+            chunk = changed[i:i + CHUNK_SIZE]
+            existing = set(Relationship.objects.filter(
+                _edges_query(chunk), status=status_id, site=site_id
+            ).values_list('from_user', 'to_user'))
+            self._add(existing, self.added_forward, self.added_reverse)
+            self._add([edge for edge in chunk if edge not in existing],
+                      self.removed_forward, self.removed_reverse)
+
+    def following(self, user_id):
+        user_ids = set(self.forward.neighbours(user_id))
+        user_ids.update(self.added_forward.get(user_id, ()))
+        user_ids.difference_update(self.removed_forward.get(user_id, ()))
+        return user_ids
+
+    def followers(self, user_id):
+        user_ids = set(self.reverse.neighbours(user_id))
+        user_ids.update(self.added_reverse.get(user_id, ()))
+        user_ids.difference_update(self.removed_reverse.get(user_id, ()))
+        return user_ids
+
+    def friends(self, user_id):
+        return self.following(user_id) & self.followers(user_id)
+
+    def exists(self, from_user_id, to_user_id):
+        if to_user_id in self.removed_forward.get(from_user_id, ()):
+            return False
+        return (self.forward.has_edge(from_user_id, to_user_id) or
+                to_user_id in self.added_forward.get(from_user_id, ()))
+
+
+class RelationshipGraph(object):
+    """
+    Answers relationship lookups for one status and site from a pair of
+    memory-mapped snapshots -- relationships from each user and to each user
+    -- as written by ``export_relationship_snapshot``.  Since the snapshots
+    are mapped read-only, every process using them shares the same pages.
+
+    Every ``refresh_interval`` seconds the snapshots are reopened if they were
+    replaced, and the changes since the snapshots' watermark are loaded from
+    the database: relationships created since then, and those deleted or
+    changing status, which are recorded in :class:`RelationshipChange` while
+    ``RELATIONSHIPS_GRAPH_DIR`` is set.
+
+    All lookups take and return user ids.
+    """
+    def __init__(self, path, reverse_path, refresh_interval=60):
+        self.path = path
+        self.reverse_path = reverse_path
+        self.refresh_interval = refresh_interval
+        self._state = None
+        self._next_check = 0
+        self._check()
+
+    def _check(self):
+        now = time.time()
+        if now >= self._next_check:
+            self._next_check = now + self.refresh_interval
+
+            old = self._state
+            file_id = tuple((stat.st_ino, stat.st_mtime) for stat in
+                            (os.stat(self.path), os.stat(self.reverse_path)))
+            if old is not None and old.file_id == file_id:
+                state = _GraphState(old.forward, old.reverse, file_id)
+            else:
+                # snapshots are swapped in with a rename, so the old mappings
+                # stay valid for any lookup still using them
+                state = _GraphState(load_snapshot(self.path),
+                                    load_snapshot(self.reverse_path), file_id)
+            state.load_delta()
+            self._state = state
+        return self._state
+
+    def refresh(self):
+        """
+        Reopens the snapshots if they were replaced and reloads the changes
+        since they were taken without waiting for the refresh interval.
+        """
+        self._next_check = 0
+        self._check()
+
+    def following(self, user_id):
+        """
+        Returns the set of ids of the users the given user has a relationship
+        to.
+        """
+        return self._check().following(user_id)
+
+    def followers(self, user_id):
+        """
+        Returns the set of ids of the users with a relationship to the given
+        user.
+        """
+        return self._check().followers(user_id)
+
+    def friends(self, user_id):
+        return self._check().friends(user_id)
+
+    def only_to(self, user_id):
+        state = self._check()
+        return state.followers(user_id) - state.following(user_id)
+
+    def only_from(self, user_id):
+        state = self._check()
+        return state.following(user_id) - state.followers(user_id)
+
+    def exists(self, from_user_id, to_user_id, symmetrical=False):
+        state = self._check()
+        found = state.exists(from_user_id, to_user_id)
+        if found and symmetrical:
+            return state.exists(to_user_id, from_user_id)
+        return found
+
+    def mutual_counts(self, user_id, candidates, symmetrical=True):
+        """
+        Returns a dictionary mapping the id of each candidate to the number
+        of friends (users followed, unless :param:`symmetrical`) they share
+        with the given user.
+        """
+        state = self._check()
+        connections = symmetrical and state.friends or state.following
+        mine = connections(user_id)
+        return dict((candidate_id, len(mine & connections(candidate_id)))
+                    for candidate_id in candidates)
+
+
+def get_graph(status, site_id=None):
+    """
+    Returns the :class:`RelationshipGraph` for the given status and site
+    (by default, the current one) from the snapshots in the
+    ``RELATIONSHIPS_GRAPH_DIR`` directory, or ``None`` if there are none, in
+    which case lookups should go through ``user.relationships``.  Graphs are
+    opened once per process.
+    """
+    directory = getattr(settings, 'RELATIONSHIPS_GRAPH_DIR', None)
+    if not directory:
+        return None
+
+    if not isinstance(status, RelationshipStatus):
+        status = RelationshipStatus.objects.get_cached(status)
+    if site_id is None:
+        site_id = get_current_site_id()
+
+    key = (directory, status.pk, site_id)
+    if key not in _graphs:
+        path = os.path.join(directory, snapshot_filename(status, site_id))
+        reverse_path = os.path.join(directory, snapshot_filename(status, site_id, True))
+        if not (os.path.exists(path) and os.path.exists(reverse_path)):
+            return None
+        _graphs[key] = RelationshipGraph(path, reverse_path,
+            getattr(settings, 'RELATIONSHIPS_GRAPH_REFRESH_INTERVAL', 60))
+    return _graphs[key]
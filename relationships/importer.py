@@ -0,0 +1,192 @@
+import csv
+import datetime
+import json
+from StringIO import StringIO
+
+from django.db import connection, transaction, IntegrityError
+
+from .compat import User
+from .listeners import get_mutually_exclusive_statuses, listener_attached
+from .models import (Relationship, RelationshipStatus, _edges_query,
+    delete_relationships, increment_counts_bulk, insert_relationships,
+    invalidate_edge_cache_bulk, set_symmetrical_flag_bulk)
+
+# rows per query, keeping the number of parameters below sqlite's limit
+CHUNK_SIZE = 100
+
+
+def read_edges(f, format='csv', offset=None):
+    """
+    Yields a ``(from_username, to_username, status_slug, offset)`` tuple for
+    every edge in a file of CSV with a ``from_user,to_user[,status]`` header
+    or of JSON objects with the same keys, one per line.  ``offset`` is the
+    position in the file after the edge, from which reading can resume.
+    """
+    fields = None
+    if format == 'csv':
+        fields = next(csv.reader([f.readline()]))
+    if offset is not None:
+        f.seek(offset)
+
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        if format == 'csv':
+            row = dict(zip(fields, [value.decode('utf-8') for value in
+                                    next(csv.reader([line]))]))
+        else:
+            row = json.loads(line)
+        yield row['from_user'], row['to_user'], row.get('status'), f.tell()
+
+
+def resolve_usernames(usernames):
+    """
+    Returns a dictionary mapping each of the given usernames that exists to
+    the user's id, with one query per chunk of usernames.
+    """
+    usernames = list(set(usernames))
+    user_ids = {}
+    for i in range(0, len(usernames), CHUNK_SIZE):
+        user_ids.update(User.objects.filter(
+            username__in=usernames[i:i + CHUNK_SIZE]
+        ).values_list('username', 'pk'))
+    return user_ids
+
+
+def insert_edges(edges, site_id):
+    """
+    Inserts relationships for the given ``(from_user_id, to_user_id,
+    status_id)`` tuples on a site, skipping those which already exist, and
+    returns the ones inserted.  When the listener from
+    :func:`relationships.listeners.attach_relationship_listener` is
+    connected, of the edges whose statuses are mutually exclusive only the
+    last is kept, and existing relationships conflicting with the inserted
+    ones are deleted.  No ``relationships_added`` signal is sent for them, but
+    the edge cache, counters and symmetrical flags are updated for the
+    inserted edges.  On PostgreSQL the edges are loaded with ``COPY``,
+    elsewhere with multi-row inserts.
+    """
+    exclusive = get_mutually_exclusive_statuses() if listener_attached() else {}
+    edges = list(set(_drop_excluded(edges, exclusive)))
+    if connection.vendor == 'postgresql':
+        inserted = _copy_edges(edges, site_id)
+    else:
+        inserted = []
+        for i in range(0, len(edges), CHUNK_SIZE):
+            inserted.extend(_insert_chunk(edges[i:i + CHUNK_SIZE], site_id))
+
+    by_status = _by_status(inserted)
+    for status_id, pairs in by_status.items():
+        _reconcile(pairs, RelationshipStatus.objects.get_cached(status_id), site_id)
+    _delete_excluded(by_status, exclusive, site_id)
+    return inserted
+
+
+def _by_status(edges):
+    by_status = {}
+    for from_user_id, to_user_id, status_id in edges:
+        by_status.setdefault(status_id, []).append((from_user_id, to_user_id))
+    return by_status
+
+
+def _reconcile(pairs, status, site_id):
+    # what the relationships_added handlers would do for the inserted edges,
+    # without announcing them to other receivers
+    invalidate_edge_cache_bulk(Relationship, edges=pairs, site_id=site_id)
+    increment_counts_bulk(Relationship, edges=pairs, status=status, site_id=site_id)
+    set_symmetrical_flag_bulk(Relationship, edges=pairs, status=status, site_id=site_id)
+
+
+def _drop_excluded(edges, exclusive):
+    # walk the edges backwards so that a later edge wins over an earlier
+    # one between the same users which it excludes
+    kept = []
+    statuses = {}
+    for from_user_id, to_user_id, status_id in reversed(list(edges)):
+        seen = statuses.setdefault((from_user_id, to_user_id), set())
+        if any(other.pk in seen for other in exclusive.get(status_id, ())):
+            continue
+        seen.add(status_id)
+        kept.append((from_user_id, to_user_id, status_id))
+    kept.reverse()
+    return kept
+
+
+def _delete_excluded(by_status, exclusive, site_id):
+    for status_id, pairs in by_status.items():
+        for other in exclusive.get(status_id, ()):
+            for i in range(0, len(pairs), CHUNK_SIZE):
+                delete_relationships(Relationship.objects.filter(
+                    _edges_query(pairs[i:i + CHUNK_SIZE]),
+                    site=site_id,
+                    status=other.pk
+                ), other, site_id)
+
+
+def _insert_chunk(edges, site_id):
+    missing = []
+    for status_id, pairs in _by_status(edges).items():
+        existing = set(Relationship.objects.filter(
+            _edges_query(pairs), status=status_id, site=site_id
+        ).values_list('from_user', 'to_user'))
+        missing.extend(Relationship(from_user_id=f, to_user_id=t, status_id=status_id,
+                                    site_id=site_id)
+                       for f, t in pairs if (f, t) not in existing)
+    if not missing:
+        return []
+    return [(r.from_user_id, r.to_user_id, r.status_id)
+            for r in insert_relationships(missing)]
+
+
+def _copy_edges(edges, site_id):
+    qn = connection.ops.quote_name
+    opts = Relationship._meta
+    columns = dict(
+        table=qn(opts.db_table),
+        from_user=qn(opts.get_field('from_user').column),
+        to_user=qn(opts.get_field('to_user').column),
+        status=qn(opts.get_field('status').column),
+        site=qn(opts.get_field('site').column),
+        created=qn(opts.get_field('created').column),
+        weight=qn(opts.get_field('weight').column),
+        symmetrical=qn(opts.get_field('symmetrical').column),
+    )
+
+    cursor = connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS relationships_import '
+                   '(from_user_id integer, to_user_id integer, status_id integer) '
+                   'ON COMMIT DELETE ROWS')
+    data = StringIO(''.join('%d\t%d\t%d\n' % edge for edge in edges))
+    cursor.copy_from(data, 'relationships_import',
+                     columns=('from_user_id', 'to_user_id', 'status_id'))
+    inserted = None
+    while inserted is None:
+        inserted = _insert_copied(cursor, columns, site_id)
+    cursor.execute('DELETE FROM relationships_import')
+    return inserted
+
+
+def _insert_copied(cursor, columns, site_id):
+    # a relationship created concurrently after the NOT EXISTS check fails
+    # the whole statement, so roll back to before it and try again, when
+    # the committed relationship will be skipped
+    sid = transaction.savepoint()
+    try:
+        cursor.execute(
+            'INSERT INTO %(table)s (%(from_user)s, %(to_user)s, %(status)s, %(site)s, '
+            '%(created)s, %(weight)s, %(symmetrical)s) '
+            'SELECT i.from_user_id, i.to_user_id, i.status_id, %%s, %%s, %%s, %%s '
+            'FROM relationships_import i WHERE NOT EXISTS (SELECT 1 FROM %(table)s r '
+            'WHERE r.%(from_user)s = i.from_user_id AND r.%(to_user)s = i.to_user_id '
+            'AND r.%(status)s = i.status_id AND r.%(site)s = %%s) '
+            'RETURNING %(from_user)s, %(to_user)s, %(status)s' % columns,
+            [site_id, datetime.datetime.now(), 1.0, False, site_id])
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return None
+    transaction.savepoint_commit(sid)
+    return [tuple(row) for row in cursor.fetchall()]
+
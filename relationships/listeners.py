@@ -1,43 +1,106 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models import signals
 
-from .models import RelationshipStatus, Relationship
+from .models import (RelationshipStatus, Relationship, _edges_query,
+    delete_relationships)
+from .signals import relationships_added
+
+
+# pairs of from_slugs which cannot both describe a relationship from one
+# user to another, i.e. following someone and blocking them
+DEFAULT_MUTUALLY_EXCLUSIVE = (('following', 'blocking'),)
+
+# pairs -> {status_id: [excluded status, ...]}
+_exclusive_cache = {}
+
+
+def get_mutually_exclusive_statuses():
+    """
+    Returns a dictionary mapping a status id to the statuses that are removed
+    when a relationship with that status is created, built from the
+    ``RELATIONSHIPS_MUTUALLY_EXCLUSIVE`` setting and remembered until the
+    setting or the statuses change.  The setting names statuses by
+    ``from_slug``; one which does not exist is an ``ImproperlyConfigured``
+    error, while the default pairs are skipped if their statuses are missing.
+    """
+    configured = hasattr(settings, 'RELATIONSHIPS_MUTUALLY_EXCLUSIVE')
+    pairs = tuple(tuple(pair) for pair in getattr(
+        settings, 'RELATIONSHIPS_MUTUALLY_EXCLUSIVE', DEFAULT_MUTUALLY_EXCLUSIVE))
+    if pairs not in _exclusive_cache:
+        exclusive = {}
+        for slugs in pairs:
+            try:
+                statuses = [RelationshipStatus.objects.by_from_slug(slug) for slug in slugs]
+            except RelationshipStatus.DoesNotExist:
+                if configured:
+                    raise ImproperlyConfigured(
+                        'RELATIONSHIPS_MUTUALLY_EXCLUSIVE names %r, but not every '
+                        'one of them is the from_slug of a status' % (slugs,))
+                continue
+            for status in statuses:
+                exclusive.setdefault(status.pk, []).extend(
+                    other for other in statuses if other.pk != status.pk)
+        _exclusive_cache.clear()
+        _exclusive_cache[pairs] = exclusive
+    return _exclusive_cache[pairs]
+
+
+def clear_mutually_exclusive_cache(sender, **kwargs):
+    _exclusive_cache.clear()
+
+signals.post_save.connect(clear_mutually_exclusive_cache, sender=RelationshipStatus)
+signals.post_delete.connect(clear_mutually_exclusive_cache, sender=RelationshipStatus)
 
 
 def mutually_exclusive_fix(sender, instance, created, **kwargs):
-    # instance will be the new relationship that was created
-    # and since some applications will want to use the default
-    # "following" and "blocking" statuses in tandem, this hook
-    # handles deleting a "following" status when a "blocking" is
-    # added, and vice-versa
-    try:
-        following = RelationshipStatus.objects.following()
-        blocking = RelationshipStatus.objects.blocking()
-    except RelationshipStatus.DoesNotExist:
-        pass
-    else:
-        # check to see if the new status is "following" or "blocking"
-        other = None
-        if instance.status == following:
-            other = blocking
-        elif instance.status == blocking:
-            other = following
-
-        if other:
-            # delete any status that may conflict with the new one
-            Relationship.objects.filter(
-                from_user=instance.from_user,
-                to_user=instance.to_user,
-                site=instance.site,
-                status=other
-            ).delete()
+    # since some applications will want to use the default "following" and
+    # "blocking" statuses in tandem, this hook deletes any relationship
+    # between the same users whose status cannot coexist with the new one
+    if not created:
+        return
+
+    for other in get_mutually_exclusive_statuses().get(instance.status_id, ()):
+        delete_relationships(Relationship.objects.filter(
+            from_user=instance.from_user_id,
+            to_user=instance.to_user_id,
+            site=instance.site_id,
+            status=other.pk
+        ), other, instance.site_id)
+
+
+def mutually_exclusive_bulk_fix(sender, edges, status, site_id, **kwargs):
+    # the same as mutually_exclusive_fix, but for a batch of relationships
+    # created by RelationshipManager.add_many(), using a single delete
+    if not edges:
+        return
+
+    for other in get_mutually_exclusive_statuses().get(status.pk, ()):
+        delete_relationships(Relationship.objects.filter(
+            _edges_query(edges),
+            site=site_id,
+            status=other.pk
+        ), other, site_id)
 
 
 DISPATCH_UID = 'relationships.listeners.exclusive_fix'
 
+# dispatch_uids of the attached listeners
+_attached = set()
 
-def attach_relationship_listener(func=mutually_exclusive_fix, dispatch_uid=DISPATCH_UID):
+
+def attach_relationship_listener(func=mutually_exclusive_fix, dispatch_uid=DISPATCH_UID,
+                                 bulk_func=mutually_exclusive_bulk_fix):
     signals.post_save.connect(func, sender=Relationship, dispatch_uid=dispatch_uid)
+    relationships_added.connect(bulk_func, sender=Relationship, dispatch_uid=dispatch_uid)
+    _attached.add(dispatch_uid)
 
 
 def detach_relationship_listener(dispatch_uid=DISPATCH_UID):
     signals.post_save.disconnect(sender=Relationship, dispatch_uid=dispatch_uid)
+    relationships_added.disconnect(sender=Relationship, dispatch_uid=dispatch_uid)
+    _attached.discard(dispatch_uid)
+
+
+def listener_attached(dispatch_uid=DISPATCH_UID):
+    return dispatch_uid in _attached
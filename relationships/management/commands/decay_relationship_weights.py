@@ -0,0 +1,76 @@
+import datetime
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.utils import timezone
+
+from relationships.management.watermark import load_watermark, save_watermark
+from relationships.weights import get_decay_function, iter_decay_weights, user_id_range
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class Command(NoArgsCommand):
+    help = ('Decays the weight of relationships by the configured decay '
+            'function, chunked by from_user id.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='float', dest='days', default=1,
+            help='Number of days to decay the weights for.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='Number of from_user ids to update per query.'),
+        make_option('--start-id', type='int', dest='start_id',
+            help='First from_user id to update, to split the work between processes.'),
+        make_option('--end-id', type='int', dest='end_id',
+            help='Last from_user id to update.'),
+        make_option('--watermark', dest='watermark',
+            help='File recording the progress of the run, which is resumed '
+                 'from there if the file exists and removed once it completes.'),
+    )
+
+    def handle_noargs(self, **options):
+        path = options['watermark']
+        state = load_watermark(path)
+        if state is not None:
+            self.stdout.write('Resuming from user %d\n' % state['next_user_id'])
+        else:
+            state = self.start(options)
+            if state is None:
+                self.stdout.write('Decayed 0 relationship weights\n')
+                return
+
+        before = datetime.datetime.strptime(state['before'], DATETIME_FORMAT)
+        if settings.USE_TZ:
+            before = timezone.make_aware(before, timezone.utc)
+        total = 0
+        for next_user_id, updated in iter_decay_weights(
+                state['multiplier'], state['next_user_id'], state['end_user_id'],
+                options['chunk_size'], before):
+            total += updated
+            if path:
+                state['next_user_id'] = next_user_id
+                save_watermark(path, state)
+
+        if path:
+            os.remove(path)
+        self.stdout.write('Decayed %d relationship weights\n' % total)
+
+    def start(self, options):
+        low, high = user_id_range()
+        if low is None:
+            return None
+        if options['start_id'] is not None:
+            low = options['start_id']
+        if options['end_id'] is not None:
+            high = options['end_id']
+        return {
+            'multiplier': get_decay_function()(options['days']),
+            'next_user_id': low,
+            'end_user_id': high,
+            # relationships created while the run is in progress are left as
+            # they are, also when it is resumed, and those the run decayed
+            # before it was interrupted are marked with this time
+            'before': timezone.now().strftime(DATETIME_FORMAT),
+        }
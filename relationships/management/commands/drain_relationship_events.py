@@ -0,0 +1,60 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from relationships.compat import atomic
+from relationships.events import deliver
+from relationships.models import RelationshipEvent
+
+
+logger = logging.getLogger('relationships.events')
+
+
+class Command(NoArgsCommand):
+    help = 'Delivers the relationship events stored by the queue backend.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+            help='Number of events to take from the queue per transaction.'),
+        make_option('--max-attempts', type='int', dest='max_attempts', default=5,
+            help='Number of times to try delivering an event before leaving it '
+                 'in the queue for inspection.'),
+    )
+
+    def handle_noargs(self, **options):
+        delivered = failed = 0
+        while True:
+            events = atomic(self.claim_batch)(options['batch_size'], options['max_attempts'])
+            if not events:
+                break
+
+            retry = []
+            for event in events:
+                try:
+                    deliver([event])
+                except Exception:
+                    logger.exception('Error delivering relationship event %s', event)
+                    event.pk = None
+                    event.attempts += 1
+                    retry.append(event)
+                else:
+                    delivered += 1
+
+            if retry:
+                RelationshipEvent.objects.bulk_create(retry)
+                failed += len([e for e in retry if e.attempts >= options['max_attempts']])
+
+        self.stdout.write('Delivered %d relationship events\n' % delivered)
+        if failed:
+            self.stdout.write('Gave up on %d relationship events\n' % failed)
+
+    def claim_batch(self, batch_size, max_attempts):
+        # the rows are locked and removed in one transaction so that drains
+        # running at the same time do not take the same events, and delivered
+        # once it has committed so that no lock is held meanwhile.  An event
+        # whose delivery fails is queued again with one more attempt.
+        events = list(RelationshipEvent.objects.select_for_update().filter(
+            attempts__lt=max_attempts)[:batch_size])
+        if events:
+            RelationshipEvent.objects.filter(pk__in=[e.pk for e in events]).delete()
+        return events
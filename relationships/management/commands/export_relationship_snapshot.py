@@ -0,0 +1,55 @@
+import os
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import CommandError, NoArgsCommand
+
+from relationships.models import RelationshipChange, RelationshipStatus
+from relationships.snapshot import export_snapshot, load_snapshot, snapshot_filename
+
+
+class Command(NoArgsCommand):
+    help = ('Writes compressed sparse row snapshots of the relationships of '
+            'each status and site, named <from_slug>-<site id>.csr, and of '
+            'the same relationships reversed, named <from_slug>-<site id>.reverse.csr.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output-dir', dest='output_dir', default='.',
+            help='Directory to write the snapshots to.'),
+        make_option('--status', dest='status',
+            help='Only export relationships with the status with this from_slug.'),
+        make_option('--site', type='int', dest='site',
+            help='Only export relationships on the site with this id.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=10000,
+            help='Number of relationships to fetch from the database at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        statuses = RelationshipStatus.objects.all()
+        if options['status']:
+            statuses = statuses.filter(from_slug=options['status'])
+            if not statuses:
+                raise CommandError('No status with the from_slug %r' % options['status'])
+
+        site_ids = Site.objects.values_list('pk', flat=True)
+        if options['site']:
+            site_ids = [options['site']]
+
+        for status in statuses:
+            for site_id in site_ids:
+                replaced = None
+                for reverse in (False, True):
+                    path = os.path.join(options['output_dir'],
+                                        snapshot_filename(status, site_id, reverse))
+                    if os.path.exists(path):
+                        with load_snapshot(path) as snapshot:
+                            replaced = min(replaced or snapshot.watermark, snapshot.watermark)
+                    num_nodes, num_edges = export_snapshot(
+                        path, status, site_id, options['chunk_size'], reverse)
+                    self.stdout.write('Wrote %s: %d relationships\n' % (path, num_edges))
+
+                if replaced is not None:
+                    # graphs still using the replaced snapshots need the
+                    # changes since those were taken, but none from before
+                    RelationshipChange.objects.filter(
+                        status_id=status.pk, site_id=site_id, changed__lt=replaced
+                    ).delete()
@@ -0,0 +1,84 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from relationships.compat import atomic
+from relationships.importer import insert_edges, read_edges, resolve_usernames
+from relationships.management.watermark import load_watermark, save_watermark
+from relationships.models import RelationshipStatus
+from relationships.sites import get_current_site_id
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Imports relationships from a CSV file with a from_user,to_user[,status] '
+            'header, or a file of JSON objects with the same keys one per line, '
+            'where status is a from_slug.  Relationships which already exist, or '
+            'whose users or status do not, are skipped.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=('csv', 'jsonl'),
+            help='Format of the file, by default guessed from its extension.'),
+        make_option('--status', dest='status', default='following',
+            help='from_slug of the status of relationships without one.'),
+        make_option('--site', type='int', dest='site',
+            help='Id of the site to import to, by default the current one.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=5000,
+            help='Number of relationships to import per transaction.'),
+        make_option('--watermark', dest='watermark',
+            help='File recording the progress of the import, which is resumed '
+                 'from there if the file exists and removed once it completes.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected the file to import')
+        path = args[0]
+        format = options['format']
+        if format is None:
+            format = path.endswith('.csv') and 'csv' or 'jsonl'
+
+        self.statuses = dict(RelationshipStatus.objects.values_list('from_slug', 'pk'))
+        if options['status'] not in self.statuses:
+            raise CommandError('No status with the from_slug %r' % options['status'])
+        self.default_status = options['status']
+        self.site_id = options['site'] or get_current_site_id()
+
+        watermark = options['watermark']
+        state = load_watermark(watermark)
+        if state is not None:
+            self.stdout.write('Resuming from byte %d\n' % state['offset'])
+        else:
+            state = {'offset': None, 'read': 0, 'imported': 0}
+
+        with open(path, 'rb') as f:
+            batch = []
+            for edge in read_edges(f, format, state['offset']):
+                batch.append(edge)
+                if len(batch) >= options['batch_size']:
+                    self.import_batch(batch, state, watermark)
+                    batch = []
+            if batch:
+                self.import_batch(batch, state, watermark)
+
+        if watermark and os.path.exists(watermark):
+            os.remove(watermark)
+        self.stdout.write('Imported %d of %d relationships\n' % (state['imported'], state['read']))
+
+    def import_batch(self, batch, state, watermark):
+        inserted = atomic(self.insert_batch)(batch)
+        state['offset'] = batch[-1][3]
+        state['read'] += len(batch)
+        state['imported'] += len(inserted)
+        if watermark:
+            save_watermark(watermark, state)
+        self.stdout.write('Read %d, imported %d relationships\n' % (state['read'], state['imported']))
+
+    def insert_batch(self, batch):
+        user_ids = resolve_usernames([e[0] for e in batch] + [e[1] for e in batch])
+        edges = []
+        for from_username, to_username, status, offset in batch:
+            status_id = self.statuses.get(status or self.default_status)
+            if from_username in user_ids and to_username in user_ids and status_id:
+                edges.append((user_ids[from_username], user_ids[to_username], status_id))
+        return insert_edges(edges, self.site_id)
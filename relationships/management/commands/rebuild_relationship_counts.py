@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from relationships.compat import atomic
+from relationships.models import RelationshipCount
+
+
+class Command(NoArgsCommand):
+    help = 'Recalculates the denormalized relationship counters from scratch.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='Number of counters to insert per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        atomic(RelationshipCount.objects.rebuild)(options['chunk_size'])
+        self.stdout.write('Rebuilt %d relationship counters\n' %
+                          RelationshipCount.objects.count())
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from relationships.compat import atomic
+from relationships.models import Relationship, rebuild_symmetrical_flags
+
+
+class Command(NoArgsCommand):
+    help = 'Recalculates whether each relationship is reciprocated.'
+
+    def handle_noargs(self, **options):
+        atomic(rebuild_symmetrical_flags)()
+        self.stdout.write('%d relationships are symmetrical\n' %
+                          Relationship.objects.filter(symmetrical=True).count())
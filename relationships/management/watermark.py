@@ -0,0 +1,22 @@
+import json
+import os
+
+
+def load_watermark(path):
+    """
+    Returns the state saved in the watermark file at ``path``, or ``None``
+    if there is none.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_watermark(path, state):
+    # write a new file and move it into place so that an interrupted
+    # write never leaves a corrupt watermark
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
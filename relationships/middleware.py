@@ -0,0 +1,17 @@
+from .sites import set_current_site_id, clear_current_site_id
+
+
+class CurrentSiteMiddleware(object):
+    """
+    Scopes relationships to ``request.site`` for the duration of the request,
+    for deployments serving several sites from one process.  It must come
+    after whichever middleware sets ``request.site``.
+    """
+    def process_request(self, request):
+        site = getattr(request, 'site', None)
+        if site is not None and site.pk:
+            set_current_site_id(site.pk)
+
+    def process_response(self, request, response):
+        clear_current_site_id()
+        return response
@@ -1,27 +1,107 @@
+import datetime
+import threading
+
 import django
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db import models, connection
+from django.db import models, connection, connections, router, transaction, IntegrityError
+from django.db.models import Count, F
+from django.db.models import signals
 from django.db.models.fields.related import create_many_related_manager, ManyToManyRel
+from django.db.models.sql.subqueries import DeleteQuery
+from django.db.models.sql.where import AND
 from django.utils.translation import ugettext_lazy as _
 
-from .compat import User
+from .cache import get_edge_cache
+from .compat import User, atomic, in_transaction, on_commit
+from .events import get_event_backend, CREATED, DELETED, STATUS_CHANGED, EVENT_CHOICES
+from .signals import relationships_added, relationships_removed
+from .sites import get_current_site_id
+
+
+# process-local registries of statuses by database alias, populated on first
+# access and cleared whenever a status is saved or deleted
+_status_cache = {}
+
+# the aliases on which this thread has changed statuses in a transaction
+# which has not been committed yet, whose registry is not shared meanwhile
+_status_state = threading.local()
+
+# the same for relationships, whose edges this thread does not share through
+# the edge cache meanwhile
+_edge_state = threading.local()
 
 
 class RelationshipStatusManager(models.Manager):
+    def _get_cache(self):
+        using = self.db
+        changed = getattr(_status_state, 'changed', ())
+        if using in changed:
+            if in_transaction(using):
+                return self._load_cache()
+            # the transaction ended without committing, so was rolled back
+            changed.discard(using)
+        if using not in _status_cache:
+            _status_cache[using] = self._load_cache()
+        return _status_cache[using]
+
+    def _load_cache(self):
+        by_pk = {}
+        by_slug = {}
+        for status in self.all():
+            by_pk[status.pk] = status
+            for field in ('from_slug', 'to_slug', 'symmetrical_slug'):
+                by_slug.setdefault((field, getattr(status, field)), []).append(status)
+        return {'pk': by_pk, 'slug': by_slug}
+
+    def _get_one(self, statuses, value):
+        # the same errors as get(), with which the statuses used to be looked up
+        if not statuses:
+            raise self.model.DoesNotExist(
+                'RelationshipStatus matching %r does not exist.' % (value,))
+        if len(statuses) > 1:
+            raise self.model.MultipleObjectsReturned(
+                'get() returned more than one RelationshipStatus -- it returned %s! '
+                'Lookup parameters were %r' % (len(statuses), value))
+        return statuses[0]
+
+    def clear_cache(self):
+        _status_cache.clear()
+
+    def get_cached(self, pk):
+        """
+        Returns the status with the given primary key without hitting the
+        database once the registry has been loaded.
+        """
+        try:
+            return self._get_cache()['pk'][int(pk)]
+        except KeyError:
+            raise self.model.DoesNotExist(
+                'RelationshipStatus matching %r does not exist.' % (pk,))
+
+    def by_from_slug(self, from_slug):
+        """
+        Returns the status with the given ``from_slug``, ignoring the other
+        slugs, from the registry.
+        """
+        return self._get_one(self._get_cache()['slug'].get(('from_slug', from_slug)),
+                             from_slug)
+
     # convenience methods to handle some default statuses
     def following(self):
-        return self.get(from_slug='following')
+        return self.by_from_slug('following')
 
     def blocking(self):
-        return self.get(from_slug='blocking')
+        return self.by_from_slug('blocking')
 
     def by_slug(self, status_slug):
-        return self.get(
-            models.Q(from_slug=status_slug) |
-            models.Q(to_slug=status_slug) |
-            models.Q(symmetrical_slug=status_slug)
-        )
+        cache = self._get_cache()
+        statuses = []
+        for field in ('from_slug', 'to_slug', 'symmetrical_slug'):
+            for status in cache['slug'].get((field, status_slug), ()):
+                if status not in statuses:
+                    statuses.append(status)
+        return self._get_one(statuses, status_slug)
 
 
 class RelationshipStatus(models.Model):
@@ -56,13 +136,30 @@ class Relationship(models.Model):
         related_name='to_users', verbose_name=_('to user'))
     status = models.ForeignKey(RelationshipStatus, verbose_name=_('status'))
     created = models.DateTimeField(_('created'), auto_now_add=True)
-    weight = models.FloatField(_('weight'), default=1.0, blank=True, null=True)
+    weight = models.FloatField(_('weight'), default=1.0, blank=True)
     site = models.ForeignKey(Site, default=settings.SITE_ID,
         verbose_name=_('site'), related_name='relationships')
+    symmetrical = models.BooleanField(_('symmetrical'), default=False,
+        help_text=_("Whether the relationship is reciprocated, maintained "
+                    "when RELATIONSHIPS_SYMMETRICAL_FLAG is set"))
+    last_decayed = models.DateTimeField(_('last decayed'), blank=True, null=True,
+        help_text=_("When the weight was last decayed, so that a decay run "
+                    "which is resumed skips the relationships it has done"))
 
     class Meta:
         unique_together = (('from_user', 'to_user', 'status', 'site'),)
         ordering = ('created',)
+        if django.VERSION >= (1, 5):
+            # the unique index leads with from_user, these serve lookups by
+            # to_user (followers), listing them newest first, listing
+            # reciprocated relationships and ranking them by weight.  On older
+            # versions they are created by the south migrations.
+            index_together = (
+                ('to_user', 'status', 'site', 'from_user'),
+                ('to_user', 'status', 'site', 'created'),
+                ('from_user', 'status', 'site', 'symmetrical'),
+                ('from_user', 'status', 'site', 'weight'),
+            )
         verbose_name = _('Relationship')
         verbose_name_plural = _('Relationships')
 
@@ -71,6 +168,751 @@ class Relationship(models.Model):
                 % {'from_user': self.from_user.username,
                    'to_user': self.to_user.username})
 
+
+FROM = 'from'
+TO = 'to'
+
+DIRECTION_CHOICES = (
+    (FROM, _('from')),
+    (TO, _('to')),
+)
+
+
+class RelationshipCountManager(models.Manager):
+    def adjust(self, deltas):
+        """
+        Apply a dictionary of deltas keyed by (user_id, status_id, direction,
+        site_id) to the counters, creating any that don't exist yet for
+        positive deltas.  Users sharing the same status, direction, site and
+        delta are updated with a single query.
+        """
+        grouped = {}
+        for (user_id, status_id, direction, site_id), delta in deltas.items():
+            if delta:
+                key = (status_id, direction, site_id, delta)
+                grouped.setdefault(key, []).append(user_id)
+
+        for (status_id, direction, site_id, delta), user_ids in grouped.items():
+            counts = self.filter(status=status_id, direction=direction, site=site_id)
+            existing = set(counts.filter(user__in=user_ids).values_list('user', flat=True))
+            if existing:
+                counts.filter(user__in=existing).update(count=F('count') + delta)
+
+            if delta < 0:
+                # a missing counter is never created to go negative, i.e. for
+                # a user whose counters were deleted along with the user
+                continue
+
+            missing = [self.model(user_id=user_id, status_id=status_id, direction=direction,
+                                  site_id=site_id, count=delta)
+                       for user_id in user_ids if user_id not in existing]
+            if missing:
+                sid = transaction.savepoint()
+                try:
+                    self.bulk_create(missing)
+                except IntegrityError:
+                    # counters were created concurrently, fall back to one
+                    # at a time
+                    transaction.savepoint_rollback(sid)
+                    for counter in missing:
+                        self._adjust_one(counter)
+                else:
+                    transaction.savepoint_commit(sid)
+
+    def _adjust_one(self, counter):
+        counts = self.filter(user=counter.user_id, status=counter.status_id,
+                             direction=counter.direction, site=counter.site_id)
+        if not counts.update(count=F('count') + counter.count) and counter.count > 0:
+            sid = transaction.savepoint()
+            try:
+                self.bulk_create([counter])
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                counts.update(count=F('count') + counter.count)
+            else:
+                transaction.savepoint_commit(sid)
+
+    def rebuild(self, chunk_size=1000):
+        """
+        Recalculate every counter from the ``Relationship`` table, streaming
+        the grouped counts and inserting them in chunks.
+        """
+        self.all().delete()
+
+        for direction, user_field in ((FROM, 'from_user'), (TO, 'to_user')):
+            grouped = Relationship.objects.order_by().values_list(
+                user_field, 'status', 'site'
+            ).annotate(count=Count('id'))
+
+            chunk = []
+            for user_id, status_id, site_id, count in grouped.iterator():
+                chunk.append(self.model(user_id=user_id, status_id=status_id,
+                                        direction=direction, site_id=site_id,
+                                        count=count))
+                if len(chunk) == chunk_size:
+                    self.bulk_create(chunk)
+                    chunk = []
+            if chunk:
+                self.bulk_create(chunk)
+
+
+class RelationshipCount(models.Model):
+    user = models.ForeignKey(User,
+        related_name='relationship_counts', verbose_name=_('user'))
+    status = models.ForeignKey(RelationshipStatus, verbose_name=_('status'))
+    direction = models.CharField(_('direction'), max_length=4,
+        choices=DIRECTION_CHOICES)
+    site = models.ForeignKey(Site, default=settings.SITE_ID,
+        verbose_name=_('site'), related_name='relationship_counts')
+    count = models.IntegerField(_('count'), default=0)
+
+    objects = RelationshipCountManager()
+
+    class Meta:
+        unique_together = (('user', 'status', 'direction', 'site'),)
+        verbose_name = _('Relationship count')
+        verbose_name_plural = _('Relationship counts')
+
+    def __unicode__(self):
+        return u'%s %s %s: %s' % (self.user_id, self.status_id, self.direction, self.count)
+
+
+class RelationshipEvent(models.Model):
+    """
+    A relationship being created, deleted or changing status.  Users and
+    statuses are stored by id so that events outlive the rows they describe.
+    """
+    event = models.CharField(_('event'), max_length=16, choices=EVENT_CHOICES)
+    from_user_id = models.IntegerField(_('from user id'))
+    to_user_id = models.IntegerField(_('to user id'))
+    status_id = models.IntegerField(_('status id'))
+    old_status_id = models.IntegerField(_('old status id'), blank=True, null=True)
+    site_id = models.IntegerField(_('site id'))
+    created = models.DateTimeField(_('created'), default=datetime.datetime.now)
+    attempts = models.IntegerField(_('attempts'), default=0)
+
+    class Meta:
+        ordering = ('id',)
+        verbose_name = _('Relationship event')
+        verbose_name_plural = _('Relationship events')
+
+    def __unicode__(self):
+        return u'%s %s -> %s (%s)' % (self.event, self.from_user_id,
+                                      self.to_user_id, self.status_id)
+
+
+class RelationshipChange(models.Model):
+    """
+    A relationship which was deleted or changed status, recorded while
+    ``RELATIONSHIPS_GRAPH_DIR`` is set so that graphs loaded from snapshots
+    can recheck it against the database.
+    """
+    from_user_id = models.IntegerField(_('from user id'))
+    to_user_id = models.IntegerField(_('to user id'))
+    status_id = models.IntegerField(_('status id'))
+    site_id = models.IntegerField(_('site id'))
+    changed = models.DateTimeField(_('changed'), default=datetime.datetime.now, db_index=True)
+
+    class Meta:
+        verbose_name = _('Relationship change')
+        verbose_name_plural = _('Relationship changes')
+
+    def __unicode__(self):
+        return u'%s -> %s (%s)' % (self.from_user_id, self.to_user_id, self.status_id)
+
+
+class AliasedWhere(object):
+    """
+    Base class for where clauses on a column of the outer query's table,
+    which are copied rather than changed when the query is relabeled so
+    that a QuerySet combined with another keeps its own aliases.
+    """
+    def clone(self):
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        return clone
+
+    def relabeled_clone(self, change_map):
+        clone = self.clone()
+        clone.alias = change_map.get(self.alias, self.alias)
+        return clone
+
+    if django.VERSION < (1, 8):
+        # older Djangos only relabel a copy of the where tree, made with
+        # deepcopy() or clone(), and know nothing of relabeled_clone()
+        def relabel_aliases(self, change_map):
+            self.alias = change_map.get(self.alias, self.alias)
+
+
+class RelationshipExists(AliasedWhere):
+    """
+    A where clause matching rows of the outer query whose user column has a
+    relationship from the given user (``'from'``) and/or to the given user
+    (``'to'``), using correlated ``EXISTS`` subqueries on the relationship
+    table.  Unlike ``.extra()`` it follows the outer table's alias when the
+    query is relabeled, so it is safe to use in a nested subquery.
+    """
+    def __init__(self, alias, column, user_id, status_id, site_id, directions, negated=False):
+        self.alias = alias
+        self.column = column
+        self.user_id = user_id
+        self.status_id = status_id
+        self.site_id = site_id
+        self.directions = directions
+        self.negated = negated
+
+    def as_sql(self, qn, connection):
+        quote = connection.ops.quote_name
+        opts = Relationship._meta
+        clauses = []
+        params = []
+        for direction in self.directions:
+            if direction == FROM:
+                user_field, outer_field = 'from_user', 'to_user'
+            else:
+                user_field, outer_field = 'to_user', 'from_user'
+
+            clauses.append(
+                'EXISTS (SELECT 1 FROM %(table)s %(rel)s '
+                'WHERE %(rel)s.%(user)s = %%s AND %(rel)s.%(outer)s = %(alias)s.%(column)s '
+                'AND %(rel)s.%(status)s = %%s AND %(rel)s.%(site)s = %%s)' % dict(
+                    table=quote(opts.db_table),
+                    rel=quote('exists_rel'),
+                    user=quote(opts.get_field(user_field).column),
+                    outer=quote(opts.get_field(outer_field).column),
+                    alias=qn(self.alias),
+                    column=quote(self.column),
+                    status=quote(opts.get_field('status').column),
+                    site=quote(opts.get_field('site').column),
+                ))
+            params.extend([self.user_id, self.status_id, self.site_id])
+
+        sql = ' AND '.join(clauses)
+        if self.negated:
+            sql = 'NOT (%s)' % sql
+        return sql, params
+
+
+class SubqueryIn(AliasedWhere):
+    """
+    A where clause matching rows of the outer query whose column is in the
+    results of a raw SQL subquery, following the outer table's alias when
+    the query is relabeled.
+    """
+    def __init__(self, alias, column, sql, params):
+        self.alias = alias
+        self.column = column
+        self.sql = sql
+        self.params = params
+
+    def as_sql(self, qn, connection):
+        return '%s.%s IN (%s)' % (
+            qn(self.alias), connection.ops.quote_name(self.column), self.sql
+        ), list(self.params)
+
+
+def symmetrical_ids_sql(user_id, status_id, site_id, using=None):
+    """
+    Returns the SQL and params selecting the ids of the users with whom the
+    given user has a reciprocated relationship, reading only the
+    relationship table: from the symmetrical flag if it is maintained,
+    otherwise by joining the table onto itself.  The SQL is for the database
+    ``using``, by default the one relationships are read from.
+    """
+    qn = connections[using or router.db_for_read(Relationship)].ops.quote_name
+    opts = Relationship._meta
+    columns = dict(
+        table=qn(opts.db_table),
+        from_user=qn(opts.get_field('from_user').column),
+        to_user=qn(opts.get_field('to_user').column),
+        status=qn(opts.get_field('status').column),
+        site=qn(opts.get_field('site').column),
+        symmetrical=qn(opts.get_field('symmetrical').column),
+        r1=qn('r1'),
+        r2=qn('r2'),
+    )
+    params = [user_id, status_id, site_id]
+
+    if symmetrical_flag_enabled():
+        sql = ('SELECT %(r1)s.%(to_user)s FROM %(table)s %(r1)s '
+               'WHERE %(r1)s.%(from_user)s = %%s AND %(r1)s.%(status)s = %%s '
+               'AND %(r1)s.%(site)s = %%s AND %(r1)s.%(symmetrical)s = %%s')
+        params.append(True)
+    else:
+        sql = ('SELECT %(r1)s.%(to_user)s FROM %(table)s %(r1)s '
+               'INNER JOIN %(table)s %(r2)s ON (%(r2)s.%(from_user)s = %(r1)s.%(to_user)s '
+               'AND %(r2)s.%(to_user)s = %(r1)s.%(from_user)s '
+               'AND %(r2)s.%(status)s = %(r1)s.%(status)s AND %(r2)s.%(site)s = %(r1)s.%(site)s) '
+               'WHERE %(r1)s.%(from_user)s = %%s AND %(r1)s.%(status)s = %%s '
+               'AND %(r1)s.%(site)s = %%s')
+
+    return sql % columns, params
+
+
+def relationship_ids(user_id, status_id, site_id, directions):
+    """
+    Returns a flat ``values_list`` of the ids of the users with a relationship
+    from the given user (``'from'``) and/or to the given user (``'to'``),
+    read from the relationship table without joining the user table.
+    """
+    if FROM not in directions:
+        return Relationship.objects.filter(
+            to_user=user_id, status=status_id, site=site_id
+        ).values_list('from_user', flat=True)
+
+    qs = Relationship.objects.filter(from_user=user_id, status=status_id, site=site_id)
+    if TO in directions:
+        if symmetrical_flag_enabled():
+            qs = qs.filter(symmetrical=True)
+        else:
+            qs = qs.filter(to_user__in=Relationship.objects.filter(
+                to_user=user_id, status=status_id, site=site_id
+            ).values('from_user'))
+    return qs.values_list('to_user', flat=True)
+
+
+def mutual_counts_sql(user_id, candidate_ids, status_id, site_id, symmetrical=True,
+                      using=None):
+    """
+    Returns the SQL and params counting, for each candidate, the users with
+    whom both the candidate and the given user have a relationship
+    (reciprocated ones if ``symmetrical``), grouped by candidate, for the
+    database ``using``.
+    """
+    using = using or router.db_for_read(Relationship)
+    qn = connections[using].ops.quote_name
+    opts = Relationship._meta
+    columns = dict(
+        table=qn(opts.db_table),
+        from_user=qn(opts.get_field('from_user').column),
+        to_user=qn(opts.get_field('to_user').column),
+        status=qn(opts.get_field('status').column),
+        site=qn(opts.get_field('site').column),
+        symmetrical=qn(opts.get_field('symmetrical').column),
+        r1=qn('m1'),
+        r2=qn('m2'),
+        candidates=', '.join(['%s'] * len(candidate_ids)),
+    )
+    params = []
+
+    if symmetrical:
+        user_sql, user_params = symmetrical_ids_sql(user_id, status_id, site_id, using)
+    else:
+        user_sql = ('SELECT %(to_user)s FROM %(table)s WHERE %(from_user)s = %%s '
+                    'AND %(status)s = %%s AND %(site)s = %%s' % columns)
+        user_params = [user_id, status_id, site_id]
+
+    sql = 'SELECT %(r1)s.%(from_user)s, COUNT(*) FROM %(table)s %(r1)s '
+    if symmetrical and not symmetrical_flag_enabled():
+        sql += ('INNER JOIN %(table)s %(r2)s ON (%(r2)s.%(from_user)s = %(r1)s.%(to_user)s '
+                'AND %(r2)s.%(to_user)s = %(r1)s.%(from_user)s '
+                'AND %(r2)s.%(status)s = %(r1)s.%(status)s AND %(r2)s.%(site)s = %(r1)s.%(site)s) ')
+    sql += ('WHERE %(r1)s.%(from_user)s IN (%(candidates)s) '
+            'AND %(r1)s.%(status)s = %%s AND %(r1)s.%(site)s = %%s ')
+    params.extend(candidate_ids)
+    params.extend([status_id, site_id])
+    if symmetrical and symmetrical_flag_enabled():
+        sql += 'AND %(r1)s.%(symmetrical)s = %%s '
+        params.append(True)
+    sql += 'AND %(r1)s.%(to_user)s IN (' + user_sql.replace('%', '%%') + ') '
+    sql += 'GROUP BY %(r1)s.%(from_user)s'
+
+    return sql % columns, params + user_params
+
+
+def rebuild_symmetrical_flags():
+    """
+    Recalculate the symmetrical flag of every relationship with two set-based
+    updates, in one transaction on the database relationships are written to.
+    """
+    using = router.db_for_write(Relationship)
+    atomic(using=using)(_rebuild_symmetrical_flags)(using)
+
+
+def _rebuild_symmetrical_flags(using):
+    conn = connections[using]
+    qn = conn.ops.quote_name
+    opts = Relationship._meta
+    columns = dict(
+        table=qn(opts.db_table),
+        from_user=qn(opts.get_field('from_user').column),
+        to_user=qn(opts.get_field('to_user').column),
+        status=qn(opts.get_field('status').column),
+        site=qn(opts.get_field('site').column),
+        symmetrical=qn(opts.get_field('symmetrical').column),
+        r2=qn('r2'),
+    )
+
+    Relationship.objects.using(using).update(symmetrical=False)
+
+    cursor = conn.cursor()
+    if conn.vendor == 'mysql':
+        # mysql can't select from the table being updated in a subquery
+        cursor.execute(
+            'UPDATE %(table)s INNER JOIN %(table)s %(r2)s '
+            'ON (%(r2)s.%(from_user)s = %(table)s.%(to_user)s '
+            'AND %(r2)s.%(to_user)s = %(table)s.%(from_user)s '
+            'AND %(r2)s.%(status)s = %(table)s.%(status)s '
+            'AND %(r2)s.%(site)s = %(table)s.%(site)s) '
+            'SET %(table)s.%(symmetrical)s = %%s' % columns, [True])
+    else:
+        cursor.execute(
+            'UPDATE %(table)s SET %(symmetrical)s = %%s WHERE EXISTS ('
+            'SELECT 1 FROM %(table)s %(r2)s '
+            'WHERE %(r2)s.%(from_user)s = %(table)s.%(to_user)s '
+            'AND %(r2)s.%(to_user)s = %(table)s.%(from_user)s '
+            'AND %(r2)s.%(status)s = %(table)s.%(status)s '
+            'AND %(r2)s.%(site)s = %(table)s.%(site)s)' % columns, [True])
+
+
+def _edges_query(edges):
+    # group the edges by whichever side has the fewest distinct users, which
+    # for a batch from add_many() is a single user
+    from_users = {}
+    to_users = {}
+    for from_user_id, to_user_id in edges:
+        from_users.setdefault(from_user_id, []).append(to_user_id)
+        to_users.setdefault(to_user_id, []).append(from_user_id)
+
+    query = models.Q()
+    if len(from_users) <= len(to_users):
+        for from_user_id, to_user_ids in from_users.items():
+            query |= models.Q(from_user=from_user_id, to_user__in=to_user_ids)
+    else:
+        for to_user_id, from_user_ids in to_users.items():
+            query |= models.Q(to_user=to_user_id, from_user__in=from_user_ids)
+    return query
+
+
+def insert_relationships(relationships):
+    """
+    Inserts the given unsaved relationships with a single multi-row insert
+    and returns them.  If one of them was created concurrently the insert
+    fails, and they are inserted one at a time instead, returning only those
+    which did not exist.
+    """
+    sid = transaction.savepoint()
+    try:
+        Relationship.objects.bulk_create(relationships)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return [relationship for relationship in relationships
+                if _insert_relationship(relationship)]
+    transaction.savepoint_commit(sid)
+    return relationships
+
+
+def _insert_relationship(relationship):
+    sid = transaction.savepoint()
+    try:
+        Relationship.objects.bulk_create([relationship])
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+
+def delete_relationships(qs, status, site_id):
+    """
+    Deletes the relationships in ``qs``, which must all have the given status
+    and site, without loading them and sends a single
+    :data:`relationships.signals.relationships_removed` signal.  The users are
+    selected for update before the relationships are deleted by primary key,
+    so that of two concurrent deletes only the first announces a relationship.
+
+    When ``RELATIONSHIPS_DELETE_SIGNALS`` is set the relationships are deleted
+    with ``QuerySet.delete()`` instead, sending ``pre_delete`` and
+    ``post_delete`` for every one of them.
+    """
+    atomic(using=qs.db)(_delete_relationships)(qs, status, site_id)
+
+
+def _delete_relationships(qs, status, site_id):
+    if getattr(settings, 'RELATIONSHIPS_DELETE_SIGNALS', False):
+        qs.delete()
+        return
+
+    rows = list(qs.select_for_update().values_list('pk', 'from_user', 'to_user'))
+    DeleteQuery(Relationship).delete_batch([row[0] for row in rows], qs.db)
+    edges = [row[1:] for row in rows]
+
+    if edges:
+        relationships_removed.send(sender=Relationship, edges=edges,
+                                   status=status, site_id=site_id)
+
+
+def symmetrical_flag_enabled():
+    return getattr(settings, 'RELATIONSHIPS_SYMMETRICAL_FLAG', False)
+
+
+def counters_enabled():
+    return getattr(settings, 'RELATIONSHIPS_COUNTERS', False)
+
+
+def graph_changes_enabled():
+    return bool(getattr(settings, 'RELATIONSHIPS_GRAPH_DIR', None))
+
+
+def clear_status_cache(sender, using, **kwargs):
+    # a registry loaded before the transaction commits would hold the change
+    # even if it is rolled back, so until then this thread reads statuses
+    # from the database.  Other threads may load the old statuses meanwhile,
+    # so the registries are cleared again once the change is committed.
+    RelationshipStatus.objects.clear_cache()
+    changed = _status_state.__dict__.setdefault('changed', set())
+    changed.add(using)
+
+    def committed():
+        changed.discard(using)
+        RelationshipStatus.objects.clear_cache()
+    on_commit(committed, using=using)
+
+signals.post_save.connect(clear_status_cache, sender=RelationshipStatus)
+signals.post_delete.connect(clear_status_cache, sender=RelationshipStatus)
+
+
+def edges_changed(using):
+    """
+    Returns whether this thread has changed relationships on the database
+    ``using`` in a transaction which has not been committed yet, in which
+    case it should neither read nor fill the edge cache.
+    """
+    changed = getattr(_edge_state, 'changed', ())
+    if using in changed:
+        if in_transaction(using):
+            return True
+        # the transaction ended without committing, so was rolled back
+        changed.discard(using)
+    return False
+
+
+def _invalidate_edges(edges, site_id, using):
+    # other threads may cache the old edges until the transaction commits,
+    # so they are deleted again then
+    edge_cache = get_edge_cache()
+    if edge_cache is None:
+        return
+    edge_cache.delete_many(edges, site_id)
+    changed = _edge_state.__dict__.setdefault('changed', set())
+    changed.add(using)
+
+    def committed():
+        changed.discard(using)
+        edge_cache.delete_many(edges, site_id)
+    on_commit(committed, using=using)
+
+
+def invalidate_edge_cache(sender, instance, using, **kwargs):
+    _invalidate_edges([(instance.from_user_id, instance.to_user_id)],
+                      instance.site_id, using)
+
+
+def invalidate_edge_cache_bulk(sender, edges, site_id, **kwargs):
+    _invalidate_edges(list(edges), site_id, router.db_for_write(Relationship))
+
+
+def _count_deltas(instance, status_id, delta):
+    return {
+        (instance.from_user_id, status_id, FROM, instance.site_id): delta,
+        (instance.to_user_id, status_id, TO, instance.site_id): delta,
+    }
+
+
+def _adjust_counts(instance, delta):
+    RelationshipCount.objects.adjust(_count_deltas(instance, instance.status_id, delta))
+
+
+def increment_counts(sender, instance, created, **kwargs):
+    # must run before send_saved_event(), which resets _loaded_status_id
+    if not counters_enabled():
+        return
+    old_status_id = getattr(instance, '_loaded_status_id', None)
+    if created:
+        _adjust_counts(instance, 1)
+    elif old_status_id is not None and old_status_id != instance.status_id:
+        # the relationship moves from the count of its old status to the new
+        deltas = _count_deltas(instance, old_status_id, -1)
+        deltas.update(_count_deltas(instance, instance.status_id, 1))
+        RelationshipCount.objects.adjust(deltas)
+
+
+def decrement_counts(sender, instance, **kwargs):
+    if counters_enabled():
+        _adjust_counts(instance, -1)
+
+
+def _adjust_counts_bulk(edges, status, site_id, delta):
+    deltas = {}
+    for from_user_id, to_user_id in edges:
+        for key in ((from_user_id, status.pk, FROM, site_id),
+                    (to_user_id, status.pk, TO, site_id)):
+            deltas[key] = deltas.get(key, 0) + delta
+    RelationshipCount.objects.adjust(deltas)
+
+
+def increment_counts_bulk(sender, edges, status, site_id, **kwargs):
+    if counters_enabled():
+        _adjust_counts_bulk(edges, status, site_id, 1)
+
+
+def decrement_counts_bulk(sender, edges, status, site_id, **kwargs):
+    if counters_enabled():
+        _adjust_counts_bulk(edges, status, site_id, -1)
+
+
+def set_symmetrical_flag(sender, instance, created, **kwargs):
+    # must run before send_saved_event(), which resets _loaded_status_id
+    if not symmetrical_flag_enabled():
+        return
+    if not created:
+        old_status_id = getattr(instance, '_loaded_status_id', None)
+        if old_status_id is None or old_status_id == instance.status_id:
+            return
+        # the relationship no longer reciprocates one with its old status
+        Relationship.objects.filter(
+            from_user=instance.to_user_id,
+            to_user=instance.from_user_id,
+            status=old_status_id,
+            site=instance.site_id
+        ).update(symmetrical=False)
+
+    reverse = Relationship.objects.filter(
+        from_user=instance.to_user_id,
+        to_user=instance.from_user_id,
+        status=instance.status_id,
+        site=instance.site_id)
+    symmetrical = bool(reverse.update(symmetrical=True))
+    if symmetrical or instance.symmetrical:
+        Relationship.objects.filter(pk=instance.pk).update(symmetrical=symmetrical)
+        instance.symmetrical = symmetrical
+
+
+def clear_symmetrical_flag(sender, instance, **kwargs):
+    if symmetrical_flag_enabled():
+        Relationship.objects.filter(
+            from_user=instance.to_user_id,
+            to_user=instance.from_user_id,
+            status=instance.status_id,
+            site=instance.site_id
+        ).update(symmetrical=False)
+
+
+def set_symmetrical_flag_bulk(sender, edges, status, site_id, **kwargs):
+    if not symmetrical_flag_enabled() or not edges:
+        return
+    reverse = Relationship.objects.filter(
+        _edges_query([(t, f) for f, t in edges]), status=status, site=site_id)
+    reciprocated = list(reverse.values_list('to_user', 'from_user'))
+    if reciprocated:
+        reverse.update(symmetrical=True)
+        Relationship.objects.filter(
+            _edges_query(reciprocated), status=status, site=site_id
+        ).update(symmetrical=True)
+
+def clear_symmetrical_flag_bulk(sender, edges, status, site_id, **kwargs):
+    if symmetrical_flag_enabled() and edges:
+        Relationship.objects.filter(
+            _edges_query([(t, f) for f, t in edges]), status=status, site=site_id
+        ).update(symmetrical=False)
+
+
+def _event(event, from_user_id, to_user_id, status_id, site_id, old_status_id=None):
+    return RelationshipEvent(event=event, from_user_id=from_user_id,
+                             to_user_id=to_user_id, status_id=status_id,
+                             old_status_id=old_status_id, site_id=site_id)
+
+
+def remember_status(sender, instance, **kwargs):
+    instance._loaded_status_id = instance.status_id
+
+
+def _changes(edges, status_id, site_id):
+    return [RelationshipChange(from_user_id=from_user_id, to_user_id=to_user_id,
+                               status_id=status_id, site_id=site_id)
+            for from_user_id, to_user_id in edges]
+
+
+def record_status_change(sender, instance, created, **kwargs):
+    # must run before send_saved_event(), which resets _loaded_status_id
+    old_status_id = getattr(instance, '_loaded_status_id', None)
+    if created or old_status_id == instance.status_id or not graph_changes_enabled():
+        return
+    edge = [(instance.from_user_id, instance.to_user_id)]
+    RelationshipChange.objects.bulk_create(
+        _changes(edge, old_status_id, instance.site_id) +
+        _changes(edge, instance.status_id, instance.site_id))
+
+
+def record_deletion(sender, instance, **kwargs):
+    if graph_changes_enabled():
+        RelationshipChange.objects.bulk_create(_changes(
+            [(instance.from_user_id, instance.to_user_id)],
+            instance.status_id, instance.site_id))
+
+
+def record_deletions_bulk(sender, edges, status, site_id, **kwargs):
+    if graph_changes_enabled() and edges:
+        RelationshipChange.objects.bulk_create(_changes(edges, status.pk, site_id))
+
+
+def send_saved_event(sender, instance, created, **kwargs):
+    backend = get_event_backend()
+    old_status_id = getattr(instance, '_loaded_status_id', None)
+    instance._loaded_status_id = instance.status_id
+    if backend is None:
+        return
+    if created:
+        event, old_status_id = CREATED, None
+    elif old_status_id != instance.status_id:
+        event = STATUS_CHANGED
+    else:
+        return
+    backend.enqueue([_event(event, instance.from_user_id, instance.to_user_id,
+                            instance.status_id, instance.site_id, old_status_id)])
+
+
+def send_deleted_event(sender, instance, **kwargs):
+    backend = get_event_backend()
+    if backend is not None:
+        backend.enqueue([_event(DELETED, instance.from_user_id, instance.to_user_id,
+                                instance.status_id, instance.site_id)])
+
+
+def send_added_events(sender, edges, status, site_id, **kwargs):
+    backend = get_event_backend()
+    if backend is not None and edges:
+        backend.enqueue([_event(CREATED, from_user_id, to_user_id, status.pk, site_id)
+                         for from_user_id, to_user_id in edges])
+
+def send_removed_events(sender, edges, status, site_id, **kwargs):
+    backend = get_event_backend()
+    if backend is not None and edges:
+        backend.enqueue([_event(DELETED, from_user_id, to_user_id, status.pk, site_id)
+                         for from_user_id, to_user_id in edges])
+
+signals.post_save.connect(invalidate_edge_cache, sender=Relationship)
+signals.post_delete.connect(invalidate_edge_cache, sender=Relationship)
+relationships_added.connect(invalidate_edge_cache_bulk, sender=Relationship)
+signals.post_save.connect(increment_counts, sender=Relationship)
+signals.post_delete.connect(decrement_counts, sender=Relationship)
+relationships_added.connect(increment_counts_bulk, sender=Relationship)
+signals.post_save.connect(set_symmetrical_flag, sender=Relationship)
+signals.post_delete.connect(clear_symmetrical_flag, sender=Relationship)
+relationships_added.connect(set_symmetrical_flag_bulk, sender=Relationship)
+signals.post_init.connect(remember_status, sender=Relationship)
+signals.post_save.connect(record_status_change, sender=Relationship)
+signals.post_delete.connect(record_deletion, sender=Relationship)
+signals.post_save.connect(send_saved_event, sender=Relationship)
+signals.post_delete.connect(send_deleted_event, sender=Relationship)
+relationships_added.connect(send_added_events, sender=Relationship)
+relationships_removed.connect(invalidate_edge_cache_bulk, sender=Relationship)
+relationships_removed.connect(decrement_counts_bulk, sender=Relationship)
+relationships_removed.connect(clear_symmetrical_flag_bulk, sender=Relationship)
+relationships_removed.connect(send_removed_events, sender=Relationship)
+relationships_removed.connect(record_deletions_bulk, sender=Relationship)
+
+
 field = models.ManyToManyField(User, through=Relationship,
                                symmetrical=False, related_name='related_to')
 
@@ -79,7 +921,9 @@ class RelationshipManager(User._default_manager.__class__):
     def __init__(self, instance=None, *args, **kwargs):
         super(RelationshipManager, self).__init__(*args, **kwargs)
         self.instance = instance
+        self.site_id = get_current_site_id()
 
+    @atomic
     def add(self, user, status=None, symmetrical=False):
         """
         Add a relationship from one user to another with the given status,
@@ -101,7 +945,8 @@ class RelationshipManager(User._default_manager.__class__):
             from_user=self.instance,
             to_user=user,
             status=status,
-            site=Site.objects.get_current()
+            site__pk=self.site_id,
+            defaults={'site_id': self.site_id}
         )
 
         if symmetrical:
@@ -109,6 +954,7 @@ class RelationshipManager(User._default_manager.__class__):
         else:
             return relationship
 
+    @atomic
     def remove(self, user, status=None, symmetrical=False):
         """
         Remove a relationship from one user to another, with the same caveats
@@ -117,78 +963,372 @@ class RelationshipManager(User._default_manager.__class__):
         if not status:
             status = RelationshipStatus.objects.following()
 
-        res = Relationship.objects.filter(
+        res = delete_relationships(Relationship.objects.filter(
             from_user=self.instance,
             to_user=user,
             status=status,
-            site__pk=settings.SITE_ID
-        ).delete()
+            site=self.site_id
+        ), status, self.site_id)
 
         if symmetrical:
             return (res, user.relationships.remove(self.instance, status, False))
         else:
             return res
 
+    @atomic
+    def add_many(self, users, status=None, symmetrical=False):
+        """
+        Add relationships from one user to each of the given users with a
+        single insert, skipping any relationships that already exist.  Returns
+        a list of the relationships that were created, or a 2-tuple of lists
+        if :param:`symmetrical` is set.  Like any instances saved with
+        ``bulk_create()``, these do not have their primary key set.
+
+        Instead of a ``post_save`` for every relationship, a single
+        :data:`relationships.signals.relationships_added` signal is sent.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+
+        user_ids = set(getattr(user, 'pk', user) for user in users)
+        created = self._add_many(user_ids, status, False)
+
+        if symmetrical:
+            return (created, self._add_many(user_ids, status, True))
+        else:
+            return created
+
+    def _add_many(self, user_ids, status, reverse):
+        site_id = self.site_id
+        if reverse:
+            query = dict(from_user__in=user_ids, to_user=self.instance)
+            existing = set(Relationship.objects.filter(
+                status=status, site=site_id, **query
+            ).values_list('from_user', flat=True))
+            edges = [(user_id, self.instance.pk) for user_id in user_ids - existing]
+        else:
+            query = dict(from_user=self.instance, to_user__in=user_ids)
+            existing = set(Relationship.objects.filter(
+                status=status, site=site_id, **query
+            ).values_list('to_user', flat=True))
+            edges = [(self.instance.pk, user_id) for user_id in user_ids - existing]
+
+        if not edges:
+            return []
+
+        created = insert_relationships([
+            Relationship(from_user_id=from_user_id, to_user_id=to_user_id,
+                         status=status, site_id=site_id)
+            for from_user_id, to_user_id in edges])
+        edges = [(r.from_user_id, r.to_user_id) for r in created]
+
+        relationships_added.send(sender=Relationship, edges=edges,
+                                 status=status, site_id=site_id)
+        return created
+
+    @atomic
+    def remove_many(self, users, status=None, symmetrical=False):
+        """
+        Remove the relationships from one user to each of the given users with
+        a single delete, with the same caveats and behavior as
+        :method:`add_many`.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+
+        user_ids = set(getattr(user, 'pk', user) for user in users)
+
+        res = delete_relationships(Relationship.objects.filter(
+            from_user=self.instance,
+            to_user__in=user_ids,
+            status=status,
+            site=self.site_id
+        ), status, self.site_id)
+
+        if symmetrical:
+            return (res, delete_relationships(Relationship.objects.filter(
+                from_user__in=user_ids,
+                to_user=self.instance,
+                status=status,
+                site=self.site_id
+            ), status, self.site_id))
+        else:
+            return res
+
     def _get_from_query(self, status):
         return dict(
             to_users__from_user=self.instance,
             to_users__status=status,
-            to_users__site__pk=settings.SITE_ID,
+            to_users__site=self.site_id,
         )
 
     def _get_to_query(self, status):
         return dict(
             from_users__to_user=self.instance,
             from_users__status=status,
-            from_users__site__pk=settings.SITE_ID
+            from_users__site=self.site_id
         )
 
-    def get_relationships(self, status, symmetrical=False):
+    def get_relationships(self, status, symmetrical=False, order_by_weight=False, limit=None):
         """
         Returns a QuerySet of user objects with which the given user has
-        established a relationship.
+        established a relationship.  With :param:`order_by_weight` the users
+        are ordered by the weight of the relationship, heaviest first, and
+        :param:`limit` returns only that many of them.
         """
-        query = self._get_from_query(status)
+        if symmetrical and not order_by_weight:
+            # ids of mutual relationships are read from the relationship
+            # table alone rather than joining it twice onto the user table
+            qs = User.objects.all()
+            sql, params = symmetrical_ids_sql(
+                self.instance.pk, getattr(status, 'pk', status), self.site_id, qs.db)
+            qs.query.where.add(SubqueryIn(
+                qs.query.get_initial_alias(), User._meta.pk.column, sql, params
+            ), AND)
+        else:
+            qs = User.objects.filter(**self._get_from_query(status))
+            if symmetrical:
+                # the relationship from the given user is joined to order by
+                # its weight, so test for the reverse one with EXISTS
+                qs = self._exists_clause(qs, status, (TO,))
+            if order_by_weight:
+                qs = self._order_by_weight(qs)
 
-        if symmetrical:
-            query.update(self._get_to_query(status))
+        if limit is not None:
+            return qs[:limit]
+        return self._remember_filter(qs, status, symmetrical and (FROM, TO) or (FROM,))
+
+    def _order_by_weight(self, qs):
+        # order by the weight of the joined relationship, which is not null
+        # so that the (from_user, status, site, weight) index serves it
+        alias = qs.query.table_map[Relationship._meta.db_table][0]
+        qn = connections[qs.db].ops.quote_name
+        return qs.extra(
+            select={'relationship_weight': '%s.%s' % (
+                qn(alias), qn(Relationship._meta.get_field('weight').column))},
+            order_by=['-relationship_weight'])
 
-        return User.objects.filter(**query)
+    def adjust_weight(self, user, delta, status=None):
+        """
+        Adds :param:`delta` to the weight of the relationship from the given
+        user to another, in the database so that concurrent adjustments are
+        not lost.  Returns the number of relationships updated.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+
+        return Relationship.objects.filter(
+            from_user=self.instance,
+            to_user=user,
+            status=status,
+            site=self.site_id
+        ).update(weight=F('weight') + delta)
 
     def get_related_to(self, status):
         """
         Returns a QuerySet of user objects which have created a relationship to
         the given user.
         """
-        return User.objects.filter(**self._get_to_query(status))
+        qs = User.objects.filter(**self._get_to_query(status))
+        return self._remember_filter(qs, status, (TO,))
+
+    def get_relationship_ids(self, status, symmetrical=False):
+        """
+        Returns the ids of the users :meth:`get_relationships` would return,
+        as a flat ``values_list`` which never touches the user table, i.e. to
+        use as a subquery or for membership tests.
+        """
+        directions = symmetrical and (FROM, TO) or (FROM,)
+        qs = relationship_ids(self.instance.pk, getattr(status, 'pk', status),
+                              self.site_id, directions)
+        return self._remember_filter(qs, status, directions)
+
+    def get_related_to_ids(self, status):
+        """
+        Returns the ids of the users :meth:`get_related_to` would return, as
+        a flat ``values_list`` which never touches the user table.
+        """
+        qs = relationship_ids(self.instance.pk, getattr(status, 'pk', status),
+                              self.site_id, (TO,))
+        return self._remember_filter(qs, status, (TO,))
+
+    def _remember_filter(self, qs, status, directions):
+        # lets positive_filter() and negative_filter() test for these
+        # relationships with EXISTS instead of an IN subquery; the attribute
+        # is not copied when the QuerySet is cloned, so it is dropped as soon
+        # as the QuerySet is filtered further
+        qs._relationship_filter = (
+            self.instance.pk, getattr(status, 'pk', status), self.site_id, directions)
+        return qs
+
+    def _exists_clause(self, qs, status, directions, negated=False):
+        """
+        Filters a QuerySet of users to those with (or without) a relationship
+        from the given user (``'from'``) and/or to the given user (``'to'``).
+        """
+        qs = qs._clone()
+        qs.query.where.add(RelationshipExists(
+            qs.query.get_initial_alias(), User._meta.pk.column,
+            self.instance.pk, getattr(status, 'pk', status), self.site_id,
+            directions, negated
+        ), AND)
+        return qs
+
+    def _filter_by_slug(self, qs, status_slug, negated=False):
+        status = RelationshipStatus.objects.by_slug(status_slug)
+        if status.from_slug == status_slug:
+            directions = (FROM,)
+        elif status.to_slug == status_slug:
+            directions = (TO,)
+        else:
+            directions = (FROM, TO)
+        return self._exists_clause(qs, status, directions, negated)
+
+    def _get_by_slug(self, status_slug):
+        status = RelationshipStatus.objects.by_slug(status_slug)
+        if status.from_slug == status_slug:
+            return self.get_relationships(status)
+        elif status.to_slug == status_slug:
+            return self.get_related_to(status)
+        else:
+            return self.get_relationships(status, symmetrical=True)
+
+    def intersection(self, status_slug, *other_slugs):
+        """
+        Returns a QuerySet of user objects described by every one of the given
+        status slugs, i.e. ``intersection('followers', 'blocking')`` for the
+        followers the given user is blocking.
+        """
+        qs = self._get_by_slug(status_slug)
+        for other_slug in other_slugs:
+            qs = self._filter_by_slug(qs, other_slug)
+        return qs
+
+    def difference(self, status_slug, *other_slugs):
+        """
+        Returns a QuerySet of user objects described by the first status slug
+        but none of the others, i.e. ``difference('followers', 'following')``
+        for the followers the given user does not follow back.  The exclusion
+        is done with ``NOT EXISTS`` on the relationship table rather than a
+        ``NOT IN`` subquery.
+        """
+        qs = self._get_by_slug(status_slug)
+        for other_slug in other_slugs:
+            qs = self._filter_by_slug(qs, other_slug, negated=True)
+        return qs
 
     def only_to(self, status):
         """
         Returns a QuerySet of user objects who have created a relationship to
         the given user, but which the given user has not reciprocated
         """
-        from_relationships = self.get_relationships(status)
-        to_relationships = self.get_related_to(status)
-        return to_relationships.exclude(pk__in=from_relationships.values_list('pk'))
+        return self._exists_clause(self.get_related_to(status), status, (FROM,), negated=True)
 
     def only_from(self, status):
         """
         Like :method:`only_to`, returns user objects with whom the given user
         has created a relationship, but which have not reciprocated
         """
-        from_relationships = self.get_relationships(status)
-        to_relationships = self.get_related_to(status)
-        return from_relationships.exclude(pk__in=to_relationships.values_list('pk'))
+        return self._exists_clause(self.get_relationships(status), status, (TO,), negated=True)
+
+    def mutual_counts(self, candidates, status=None, symmetrical=True, chunk_size=500):
+        """
+        Returns a dictionary mapping the id of each of the given users to the
+        number of mutual connections they share with the given user -- users
+        they both have a relationship with, reciprocated ones (``friends()``)
+        unless :param:`symmetrical` is ``False`` -- using one query per
+        :param:`chunk_size` users.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+
+        candidate_ids = [getattr(user, 'pk', user) for user in candidates]
+        counts = dict((candidate_id, 0) for candidate_id in candidate_ids)
+        if not candidate_ids:
+            return counts
+
+        using = router.db_for_read(Relationship)
+        cursor = connections[using].cursor()
+        for i in range(0, len(candidate_ids), chunk_size):
+            # keeps the number of parameters below sqlite's limit of 999
+            sql, params = mutual_counts_sql(
+                self.instance.pk, candidate_ids[i:i + chunk_size],
+                getattr(status, 'pk', status), self.site_id, symmetrical, using)
+            cursor.execute(sql, params)
+            for candidate_id, count in cursor.fetchall():
+                counts[candidate_id] = count
+        return counts
+
+    def within_degrees(self, status, degrees=2, limit=None):
+        """
+        Returns a list of the users reachable from the given user by
+        following at most ``degrees`` relationships with the given status,
+        i.e. friends of friends, nearest first.  Each user has a ``distance``
+        attribute holding the number of hops and a ``path_count`` with the
+        number of shortest paths, which at distance 2 is the number of mutual
+        connections.  Users at the same distance are ordered by path count.
+
+        Users are reached one hop at a time, never expanding a user twice,
+        with one query per degree (per 500 users reached at the previous
+        degree), followed by a query for the users.
+        """
+        rows = self._within_degrees(status, degrees, limit)
+
+        users = User.objects.in_bulk([user_id for user_id, distance, paths in rows])
+        result = []
+        for user_id, distance, paths in rows:
+            if user_id in users:
+                user = users[user_id]
+                user.distance = distance
+                user.path_count = paths
+                result.append(user)
+        return result
+
+    def _within_degrees(self, status, degrees, limit, chunk_size=500):
+        # expand a frontier of users one hop at a time, counting the shortest
+        # paths to each newly reached user
+        distances = {self.instance.pk: 0}
+        frontier = {self.instance.pk: 1}
+        rows = []
+        for distance in range(1, degrees + 1):
+            reached = {}
+            user_ids = list(frontier)
+            for i in range(0, len(user_ids), chunk_size):
+                edges = Relationship.objects.filter(
+                    from_user__in=user_ids[i:i + chunk_size],
+                    status=status,
+                    site=self.site_id,
+                ).values_list('from_user', 'to_user')
+                for from_user_id, to_user_id in edges:
+                    if to_user_id not in distances:
+                        reached[to_user_id] = reached.get(to_user_id, 0) + frontier[from_user_id]
+            if not reached:
+                break
+            for user_id, paths in reached.items():
+                distances[user_id] = distance
+                rows.append((user_id, distance, paths))
+            if limit is not None and len(rows) >= limit:
+                break  # anybody further away would be cut off
+            frontier = reached
+
+        rows.sort(key=lambda row: (row[1], -row[2], row[0]))
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
 
     def exists(self, user, status=None, symmetrical=False):
         """
         Returns boolean whether or not a relationship exists between the given
         users.  An optional :class:`RelationshipStatus` instance can be specified.
         """
+        edge_cache = get_edge_cache()
+        if edge_cache is not None and not edges_changed(router.db_for_write(Relationship)):
+            return self._exists_cached(edge_cache, user, status, symmetrical)
+
         query = dict(
             to_users__from_user=self.instance,
             to_users__to_user=user,
-            to_users__site__pk=settings.SITE_ID,
+            to_users__site=self.site_id,
         )
 
         if status:
@@ -198,7 +1338,7 @@ class RelationshipManager(User._default_manager.__class__):
             query.update(
                 from_users__to_user=self.instance,
                 from_users__from_user=user,
-                from_users__site__pk=settings.SITE_ID
+                from_users__site=self.site_id
             )
 
             if status:
@@ -206,6 +1346,148 @@ class RelationshipManager(User._default_manager.__class__):
 
         return User.objects.filter(**query).exists()
 
+    def bulk_exists(self, users, status=None, symmetrical=False):
+        """
+        Returns the set of ids of the given users with whom the given user has
+        a relationship -- the bulk equivalent of calling :method:`exists` for
+        each user.  ``users`` may contain user objects or ids.
+        """
+        user_ids = [getattr(user, 'pk', user) for user in users]
+        if not user_ids:
+            return set()
+
+        query = dict(
+            from_user=self.instance,
+            to_user__in=user_ids,
+            site=self.site_id,
+        )
+        if status:
+            query.update(status=status)
+
+        found = set(Relationship.objects.filter(**query).values_list('to_user', flat=True))
+
+        if symmetrical and found:
+            query = dict(
+                from_user__in=found,
+                to_user=self.instance,
+                site=self.site_id,
+            )
+            if status:
+                query.update(status=status)
+
+            found &= set(Relationship.objects.filter(**query).values_list('from_user', flat=True))
+
+        return found
+
+    def bulk_related_to(self, users, status=None):
+        """
+        Returns the set of ids of the given users who have created a
+        relationship to the given user.
+        """
+        user_ids = [getattr(user, 'pk', user) for user in users]
+        if not user_ids:
+            return set()
+
+        query = dict(
+            from_user__in=user_ids,
+            to_user=self.instance,
+            site=self.site_id,
+        )
+        if status:
+            query.update(status=status)
+
+        return set(Relationship.objects.filter(**query).values_list('from_user', flat=True))
+
+    def _exists_cached(self, edge_cache, user, status=None, symmetrical=False):
+        pairs = [(self.instance.pk, user.pk)]
+        if symmetrical:
+            pairs.append((user.pk, self.instance.pk))
+
+        edges = edge_cache.get_many(pairs, self.site_id)
+        missing = [pair for pair in pairs if pair not in edges]
+        if missing:
+            # load the statuses for both directions in a single query
+            loaded = dict((pair, []) for pair in missing)
+            query = models.Q()
+            for from_user_id, to_user_id in missing:
+                query |= models.Q(from_user=from_user_id, to_user=to_user_id)
+
+            rel_qs = Relationship.objects.filter(query, site=self.site_id)
+            for from_user_id, to_user_id, status_id in rel_qs.values_list(
+                    'from_user', 'to_user', 'status'):
+                loaded[(from_user_id, to_user_id)].append(status_id)
+
+            edge_cache.set_many(loaded, self.site_id)
+            edges.update(loaded)
+
+        for pair in pairs:
+            if status:
+                if status.pk not in edges[pair]:
+                    return False
+            elif not edges[pair]:
+                return False
+        return True
+
+    def get_count(self, status, direction=FROM):
+        """
+        Returns the number of relationships the given user has created
+        (``direction='from'``) or that have been created to the given user
+        (``direction='to'``).  When ``RELATIONSHIPS_COUNTERS`` is enabled this
+        reads a single denormalized counter instead of counting rows.
+        """
+        if not counters_enabled():
+            if direction == FROM:
+                return self.get_relationships(status).count()
+            return self.get_related_to(status).count()
+
+        try:
+            return RelationshipCount.objects.get(
+                user=self.instance,
+                status=status,
+                direction=direction,
+                site=self.site_id
+            ).count
+        except RelationshipCount.DoesNotExist:
+            return 0
+
+    def iter_edges(self, direction=FROM, statuses=None, chunk_size=1000):
+        """
+        Yields a ``(from_user_id, to_user_id, status_id, created)`` tuple for
+        every relationship the given user has created (``direction='from'``)
+        or that has been created to the given user (``direction='to'``), with
+        the given statuses (by default, all of them).
+
+        Relationships are fetched ``chunk_size`` at a time per status, ordered
+        by the other user's id along an index, and no model instances are
+        built, so memory use stays flat however many relationships there are.
+        """
+        if statuses is None:
+            status_ids = sorted(RelationshipStatus.objects._get_cache()['pk'])
+        else:
+            status_ids = [getattr(status, 'pk', status) for status in statuses]
+
+        if direction == FROM:
+            user_field, other_field = 'from_user', 'to_user'
+        else:
+            user_field, other_field = 'to_user', 'from_user'
+
+        for status_id in status_ids:
+            last_id = 0
+            while True:
+                chunk = list(Relationship.objects.filter(**{
+                    user_field: self.instance,
+                    'status': status_id,
+                    'site': self.site_id,
+                    '%s__gt' % other_field: last_id,
+                }).order_by(other_field).values_list(
+                    'from_user', 'to_user', 'status', 'created'
+                )[:chunk_size])
+                for edge in chunk:
+                    yield edge
+                if len(chunk) < chunk_size:
+                    break
+                last_id = chunk[-1][direction == FROM and 1 or 0]
+
     # some defaults
     def following(self):
         return self.get_relationships(RelationshipStatus.objects.following())
@@ -222,6 +1504,27 @@ class RelationshipManager(User._default_manager.__class__):
     def friends(self):
         return self.get_relationships(RelationshipStatus.objects.following(), True)
 
+    def following_ids(self):
+        return self.get_relationship_ids(RelationshipStatus.objects.following())
+
+    def followers_ids(self):
+        return self.get_related_to_ids(RelationshipStatus.objects.following())
+
+    def blocking_ids(self):
+        return self.get_relationship_ids(RelationshipStatus.objects.blocking())
+
+    def blockers_ids(self):
+        return self.get_related_to_ids(RelationshipStatus.objects.blocking())
+
+    def friends_ids(self):
+        return self.get_relationship_ids(RelationshipStatus.objects.following(), True)
+
+    def following_count(self):
+        return self.get_count(RelationshipStatus.objects.following(), FROM)
+
+    def followers_count(self):
+        return self.get_count(RelationshipStatus.objects.following(), TO)
+
 
 if django.VERSION < (1, 2):
 
@@ -0,0 +1,13 @@
+import datetime
+
+from django.db import models
+
+from relationships.compat import User
+
+
+class Post(models.Model):
+    author = models.ForeignKey(User, related_name='posts')
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        ordering = ('-created', '-id')
@@ -1,16 +1,47 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.db.models.signals import post_delete
+from django.core.urlresolvers import resolve, reverse
 from django.template import Template, Context
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 
 from relationships.forms import RelationshipStatusAdminForm
-from relationships.listeners import (attach_relationship_listener,
+from relationships.middleware import CurrentSiteMiddleware
+from relationships.listeners import (get_mutually_exclusive_statuses,
+    attach_relationship_listener,
     detach_relationship_listener)
-from relationships.models import Relationship, RelationshipStatus
+from relationships.models import (Relationship, RelationshipStatus,
+    RelationshipChange, RelationshipCount, RelationshipEvent, RelationshipExists,
+    rebuild_symmetrical_flags, _status_cache)
+from relationships.signals import relationship_event, relationships_removed
+from relationships.sites import (get_current_site_id, set_current_site_id,
+    clear_current_site_id)
 from relationships.utils import (relationship_exists, extract_user_field,
-    positive_filter, negative_filter)
-from relationships.compat import User
+    positive_filter, negative_filter, bulk_relationship_exists,
+    warm_user_field_cache, clear_user_field_cache, _user_field_cache)
+from relationships.cache import get_edge_cache
+from relationships.compat import User, atomic
+from relationships.graph import RelationshipGraph, get_graph
+from relationships.snapshot import export_snapshot, load_snapshot
+from relationships.weights import decay_weights, iter_decay_weights, user_id_range
+from relationships.relationships_tests.models import Post
+
+
+def tenth(days):
+    return 0.1
 
 
 class BaseRelationshipsTestCase(TestCase):
@@ -40,10 +71,19 @@ class BaseRelationshipsTestCase(TestCase):
         settings.SITE_ID = 1
 
         self.site = Site.objects.get_current()
+        self.commit()
 
     def tearDown(self):
         settings.SITE_ID = self.site_id
 
+    def commit(self, using='default'):
+        # the test's transaction is never committed, so run the functions
+        # queued by on_commit() as if it had been
+        conn = connections[using]
+        pending, conn._relationships_pending = getattr(conn, '_relationships_pending', []), []
+        for level, func in pending:
+            func()
+
     def _sort_by_pk(self, list_or_qs):
         annotated = [(item.pk, item) for item in list_or_qs]
         annotated.sort()
@@ -183,6 +223,455 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         rel = self.yoko.related_to.all()
         self.assertQuerysetEqual(rel, [])
 
+    def test_add_many(self):
+        created = self.john.relationships.add_many([self.walrus, self.paul, self.yoko])
+
+        # only the missing relationship was created
+        self.assertEqual([r.to_user_id for r in created], [self.walrus.pk])
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.walrus, self.paul, self.yoko])
+
+        # existing relationships are skipped without errors
+        self.assertEqual(self.john.relationships.add_many([self.walrus, self.paul]), [])
+
+        created = self.walrus.relationships.add_many([self.paul.pk, self.yoko.pk], self.blocking)
+        self.assertEqual(len(created), 2)
+        self.assertQuerysetEqual(self.walrus.relationships.blocking(), [self.paul, self.yoko])
+        self.assertQuerysetEqual(self.walrus.relationships.following(), [])
+
+    def test_add_many_symmetrical(self):
+        created, created_reverse = self.john.relationships.add_many(
+            [self.walrus, self.paul, self.yoko], symmetrical=True)
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len(created_reverse), 2)
+
+        self.assertQuerysetEqual(self.john.relationships.friends(), [self.walrus, self.paul, self.yoko])
+        self.assertQuerysetEqual(self.walrus.relationships.following(), [self.john])
+        self.assertQuerysetEqual(self.paul.relationships.following(), [self.john])
+
+    def test_remove_many(self):
+        self.john.relationships.remove_many([self.walrus, self.paul, self.yoko])
+        self.assertQuerysetEqual(self.john.relationships.following(), [])
+        self.assertQuerysetEqual(self.john.relationships.followers(), [self.yoko])
+
+        # paul is still blocking john
+        self.paul.relationships.remove_many([self.john])
+        self.assertQuerysetEqual(self.paul.relationships.blocking(), [self.john])
+
+        self.yoko.relationships.add(self.paul)
+        self.paul.relationships.add(self.yoko)
+        self.yoko.relationships.remove_many([self.john, self.paul], symmetrical=True)
+        self.assertQuerysetEqual(self.yoko.relationships.following(), [])
+        self.assertQuerysetEqual(self.yoko.relationships.followers(), [])
+
+    def test_remove_signals(self):
+        removed = []
+        deleted = []
+
+        def on_removed(sender, edges, status, site_id, **kwargs):
+            removed.append((sorted(edges), status, site_id))
+
+        def on_delete(sender, instance, **kwargs):
+            deleted.append((instance.from_user_id, instance.to_user_id))
+
+        relationships_removed.connect(on_removed)
+        post_delete.connect(on_delete, sender=Relationship)
+        try:
+            # one select and one delete, without loading any relationship
+            self.assertNumQueries(2, self.john.relationships.remove, self.yoko, self.following)
+            self.assertEqual(removed, [([(self.john.pk, self.yoko.pk)], self.following, 1)])
+
+            self.john.relationships.remove_many([self.paul, self.walrus], self.following, symmetrical=True)
+            self.assertEqual(removed[1], ([(self.john.pk, self.paul.pk)], self.following, 1))
+            self.assertEqual(len(removed), 2)
+            self.assertEqual(deleted, [])
+
+            # per-instance signals are sent instead when asked for
+            with self.settings(RELATIONSHIPS_DELETE_SIGNALS=True):
+                self.yoko.relationships.remove(self.john)
+            self.assertEqual(deleted, [(self.yoko.pk, self.john.pk)])
+            self.assertEqual(len(removed), 2)
+        finally:
+            relationships_removed.disconnect(on_removed)
+            post_delete.disconnect(on_delete, sender=Relationship)
+
+        self.assertEqual(Relationship.objects.filter(status=self.following).count(), 0)
+
+    def test_within_degrees(self):
+        self.paul.relationships.add(self.walrus)
+        self.yoko.relationships.add(self.walrus)
+        self.walrus.relationships.add(self.paul, self.blocking)
+
+        users = self.john.relationships.within_degrees(self.following)
+        self.assertEqual([(user, user.distance, user.path_count) for user in users], [
+            (self.paul, 1, 1), (self.yoko, 1, 1), (self.walrus, 2, 2)])
+        # one query per degree and one for the users
+        self.assertNumQueries(3, self.john.relationships.within_degrees, self.following)
+
+        john, walrus = self.john.relationships, self.walrus.relationships
+        self.assertEqual(john._within_degrees(self.following, 1, None), [
+            (self.paul.pk, 1, 1), (self.yoko.pk, 1, 1)])
+        self.assertEqual(john._within_degrees(self.following, 3, 2), [
+            (self.paul.pk, 1, 1), (self.yoko.pk, 1, 1)])
+        self.assertEqual(walrus._within_degrees(self.blocking, 3, None), [
+            (self.paul.pk, 1, 1), (self.john.pk, 2, 1)])
+
+        # users already reached are not expanded again, so cycles cost
+        # nothing however many degrees are asked for
+        self.walrus.relationships.add(self.john)
+        self.assertEqual(john._within_degrees(self.following, 10, None), [
+            (self.paul.pk, 1, 1), (self.yoko.pk, 1, 1), (self.walrus.pk, 2, 2)])
+        self.assertNumQueries(3, john._within_degrees, self.following, 10, None)
+
+    def test_mutual_counts(self):
+        self.paul.relationships.add(self.john)
+        self.paul.relationships.add(self.yoko, symmetrical=True)
+        self.walrus.relationships.add(self.yoko, symmetrical=True)
+        self.walrus.relationships.add(self.paul, symmetrical=True)
+        candidates = [self.walrus, self.yoko, self.paul]
+
+        self.assertNumQueries(1, self.john.relationships.mutual_counts, candidates, self.following)
+        self.assertEqual(self.john.relationships.mutual_counts(candidates), {
+            self.walrus.pk: 2, self.yoko.pk: 1, self.paul.pk: 1})
+        self.assertEqual(self.john.relationships.mutual_counts([]), {})
+
+        # candidates are counted in chunks, staying below sqlite's limit of
+        # 999 parameters however many there are
+        self.assertNumQueries(2, self.john.relationships.mutual_counts, candidates,
+                              chunk_size=2)
+        self.assertEqual(self.john.relationships.mutual_counts(candidates, chunk_size=2), {
+            self.walrus.pk: 2, self.yoko.pk: 1, self.paul.pk: 1})
+        counts = self.john.relationships.mutual_counts(
+            [self.walrus.pk] + range(10000, 11500))
+        self.assertEqual(counts[self.walrus.pk], 2)
+        self.assertEqual(len(counts), 1501)
+
+        # one-way relationships
+        self.walrus.relationships.remove(self.yoko)
+        self.assertEqual(self.john.relationships.mutual_counts(candidates, symmetrical=False), {
+            self.walrus.pk: 1, self.yoko.pk: 1, self.paul.pk: 1})
+        self.assertEqual(self.john.relationships.mutual_counts(candidates), {
+            self.walrus.pk: 1, self.yoko.pk: 1, self.paul.pk: 1})
+        self.walrus.relationships.add(self.yoko)
+
+        with self.settings(RELATIONSHIPS_SYMMETRICAL_FLAG=True):
+            rebuild_symmetrical_flags()
+            self.assertEqual(self.john.relationships.mutual_counts(candidates), {
+                self.walrus.pk: 2, self.yoko.pk: 1, self.paul.pk: 1})
+
+    def test_order_by_weight(self):
+        self.assertEqual(self.john.relationships.adjust_weight(self.yoko, 2), 1)
+        self.assertEqual(self.john.relationships.adjust_weight(self.walrus, 2), 0)
+        self.assertEqual(Relationship.objects.get(from_user=self.john, to_user=self.yoko).weight, 3.0)
+
+        following = self.john.relationships.get_relationships(self.following, order_by_weight=True)
+        self.assertEqual(str(following.query).count('JOIN'), 1)
+        self.assertEqual(list(following), [self.yoko, self.paul])
+
+        self.john.relationships.adjust_weight(self.paul, 2.5)
+        self.assertEqual(list(self.john.relationships.get_relationships(
+            self.following, order_by_weight=True, limit=1)), [self.paul])
+
+        # a new relationship weighs 1.0, so ranks above a lighter one
+        self.john.relationships.add(self.walrus)
+        self.john.relationships.adjust_weight(self.yoko, -4)
+        self.assertEqual(list(self.john.relationships.get_relationships(
+            self.following, order_by_weight=True)), [self.paul, self.walrus, self.yoko])
+        self.john.relationships.adjust_weight(self.yoko, 4)
+        self.john.relationships.remove(self.walrus)
+
+        # friends are ranked by the weight of the relationship from the user
+        self.paul.relationships.add(self.john)
+        self.paul.relationships.adjust_weight(self.john, 10)
+        self.assertEqual(list(self.john.relationships.get_relationships(
+            self.following, symmetrical=True, order_by_weight=True)), [self.paul, self.yoko])
+        self.assertEqual(list(self.yoko.relationships.get_relationships(
+            self.following, symmetrical=True, order_by_weight=True, limit=5)), [self.john])
+
+    def test_decay_weights(self):
+        def weights():
+            return list(Relationship.objects.order_by('from_user', 'to_user').values_list('weight', flat=True))
+
+        self.john.relationships.adjust_weight(self.yoko, 1)
+        self.assertEqual(weights(), [1.0, 2.0, 1.0, 1.0])
+
+        # weights halve every 30 days by default
+        self.assertEqual(decay_weights(30, chunk_size=2), 4)
+        self.assertEqual(weights(), [0.5, 1.0, 0.5, 0.5])
+
+        with self.settings(RELATIONSHIPS_DECAY_FUNCTION='relationships.relationships_tests.tests.tenth'):
+            decay_weights()
+        self.assertEqual([round(weight, 2) for weight in weights()], [0.05, 0.1, 0.05, 0.05])
+
+        # relationships already decayed by a run are skipped when it repeats
+        # a chunk, i.e. after being interrupted before recording its progress
+        before = timezone.now()
+        low, high = user_id_range()
+        self.assertEqual(list(iter_decay_weights(10, low, low, before=before)), [(low + 1, 2)])
+        self.assertEqual(sum(updated for next_user_id, updated in
+                             iter_decay_weights(10, low, high, before=before)), 2)
+        self.assertEqual([round(weight, 2) for weight in weights()], [0.5, 1.0, 0.5, 0.5])
+
+    def test_decay_command(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            watermark = os.path.join(tmp_dir, 'decay.json')
+            out = StringIO()
+            call_command('decay_relationship_weights', days=30, chunk_size=1,
+                         start_id=self.paul.pk, watermark=watermark, stdout=out)
+            self.assertEqual(out.getvalue(), 'Decayed 2 relationship weights\n')
+            self.assertFalse(os.path.exists(watermark))
+            self.assertEqual(list(Relationship.objects.filter(weight=0.5).values_list(
+                'from_user', flat=True).order_by('from_user')), [self.paul.pk, self.yoko.pk])
+
+            # an interrupted run resumes with the multiplier it started with
+            with open(watermark, 'w') as f:
+                json.dump({'multiplier': 0.1, 'next_user_id': self.john.pk,
+                           'end_user_id': self.john.pk,
+                           'before': '2100-01-01T00:00:00.000000'}, f)
+            out = StringIO()
+            call_command('decay_relationship_weights', watermark=watermark, stdout=out)
+            self.assertEqual(out.getvalue(), 'Resuming from user %d\n'
+                             'Decayed 2 relationship weights\n' % self.john.pk)
+            self.assertFalse(os.path.exists(watermark))
+            self.assertEqual(Relationship.objects.filter(weight__lt=0.2).count(), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_snapshot(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.walrus.relationships.add(self.yoko)
+            self.walrus.relationships.add(self.john)
+
+            # the edges are read a page of chunk_size at a time
+            path = os.path.join(tmp_dir, 'following.csr')
+            self.assertNumQueries(3, export_snapshot, path, self.following, 1, chunk_size=2)
+            self.assertEqual(export_snapshot(path, self.following, 1, chunk_size=2), (5, 5))
+
+            with load_snapshot(path) as snapshot:
+                self.assertEqual((snapshot.status_id, snapshot.site_id), (self.following.pk, 1))
+                self.assertEqual((snapshot.num_nodes, snapshot.num_edges), (5, 5))
+                self.assertEqual(snapshot.neighbours(self.walrus.pk), (self.john.pk, self.yoko.pk))
+                self.assertEqual(snapshot.neighbours(self.john.pk), (self.paul.pk, self.yoko.pk))
+                self.assertEqual(snapshot.neighbours(self.paul.pk), ())
+                self.assertEqual(snapshot.neighbours(self.yoko.pk), (self.john.pk,))
+                self.assertEqual(snapshot.neighbours(100), ())
+                self.assertEqual(snapshot.degree(self.john.pk), 2)
+                self.assertTrue(snapshot.has_edge(self.yoko.pk, self.john.pk))
+                self.assertFalse(snapshot.has_edge(self.john.pk, self.walrus.pk))
+
+            out = StringIO()
+            call_command('export_relationship_snapshot', output_dir=tmp_dir,
+                         status='blocking', site=1, stdout=out)
+            path = os.path.join(tmp_dir, 'blocking-1.csr')
+            reverse_path = os.path.join(tmp_dir, 'blocking-1.reverse.csr')
+            self.assertEqual(out.getvalue(), 'Wrote %s: 1 relationships\n'
+                             'Wrote %s: 1 relationships\n' % (path, reverse_path))
+            with load_snapshot(path) as snapshot:
+                self.assertEqual(snapshot.neighbours(self.paul.pk), (self.john.pk,))
+            with load_snapshot(reverse_path) as snapshot:
+                self.assertEqual(snapshot.neighbours(self.john.pk), (self.paul.pk,))
+                self.assertEqual(snapshot.neighbours(self.paul.pk), ())
+            self.assertEqual(sorted(os.listdir(tmp_dir)), [
+                'blocking-1.csr', 'blocking-1.reverse.csr', 'following.csr'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_graph(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(RELATIONSHIPS_GRAPH_DIR=tmp_dir):
+                self.assertEqual(get_graph(self.following), None)
+
+                call_command('export_relationship_snapshot', output_dir=tmp_dir,
+                             site=1, stdout=StringIO())
+                graph = get_graph(self.following)
+                self.assertTrue(get_graph(self.following.pk) is graph)
+
+            walrus, john, paul, yoko = [u.pk for u in (self.walrus, self.john, self.paul, self.yoko)]
+
+            # answered from the snapshots alone
+            path = os.path.join(tmp_dir, 'following-1.csr')
+            cached = RelationshipGraph(path, os.path.join(tmp_dir, 'following-1.reverse.csr'))
+            self.assertNumQueries(0, cached.following, john)
+            self.assertEqual(cached.following(john), set([paul, yoko]))
+            self.assertEqual(cached.followers(john), set([yoko]))
+            self.assertEqual(cached.friends(john), set([yoko]))
+            self.assertEqual(cached.only_from(john), set([paul]))
+            self.assertEqual(cached.only_to(paul), set([john]))
+            self.assertTrue(cached.exists(john, paul))
+            self.assertFalse(cached.exists(john, paul, symmetrical=True))
+            self.assertTrue(cached.exists(yoko, john, symmetrical=True))
+            self.assertEqual(cached.mutual_counts(yoko, [paul], symmetrical=False), {paul: 0})
+
+            # relationships newer than the snapshot are loaded from the database
+            graph.refresh_interval = 0
+            self.walrus.relationships.add(self.john, symmetrical=True)
+            graph.refresh()
+            self.assertEqual(graph.following(walrus), set([john]))
+            self.assertEqual(graph.followers(john), set([walrus, yoko]))
+            self.assertEqual(graph.friends(john), set([walrus, yoko]))
+            self.assertTrue(graph.exists(walrus, john, symmetrical=True))
+            self.assertEqual(graph.mutual_counts(yoko, [walrus, paul]), {walrus: 1, paul: 0})
+
+            # relationships deleted or changing status since are rechecked
+            with self.settings(RELATIONSHIPS_GRAPH_DIR=tmp_dir):
+                self.john.relationships.remove(self.yoko)
+                unblocked = Relationship.objects.get(from_user=self.paul, status=self.blocking)
+                unblocked.status = self.following
+                unblocked.save()
+            graph.refresh()
+            self.assertEqual(graph.following(john), set([paul, walrus]))
+            self.assertEqual(graph.followers(john), set([walrus, yoko, paul]))
+            self.assertEqual(graph.friends(john), set([walrus, paul]))
+            self.assertFalse(graph.exists(john, yoko))
+            self.assertTrue(graph.exists(paul, john, symmetrical=True))
+            self.assertEqual(graph.mutual_counts(yoko, [walrus, paul]), {walrus: 0, paul: 0})
+
+            # a new snapshot is picked up when it replaces the old one
+            os.rename(path, path + '.old')
+            export_snapshot(path, self.following, 1)
+            self.assertEqual(graph.following(walrus), set([john]))
+            self.assertEqual(graph._state.forward.num_edges, 5)
+
+            # changes are kept until every snapshot taken before them has
+            # been replaced by an export
+            self.assertEqual(RelationshipChange.objects.count(), 3)
+            call_command('export_relationship_snapshot', output_dir=tmp_dir, site=1, stdout=StringIO())
+            self.assertEqual(RelationshipChange.objects.count(), 3)
+            call_command('export_relationship_snapshot', output_dir=tmp_dir, site=1, stdout=StringIO())
+            self.assertEqual(RelationshipChange.objects.count(), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_iter_edges(self):
+        fans = [User.objects.create(username='fan%d' % i) for i in range(3)]
+        for fan in fans:
+            fan.relationships.add(self.john)
+
+        edges = list(self.john.relationships.iter_edges('to', [self.following], chunk_size=2))
+        self.assertEqual([(f, t, s) for f, t, s, created in edges],
+                         [(u.pk, self.john.pk, self.following.pk) for u in [self.yoko] + fans])
+
+        # one query per chunk and status, none for the users: three for the
+        # four followers and one for the blocker
+        self.assertNumQueries(4, list, self.john.relationships.iter_edges('to', chunk_size=2))
+        edges = list(self.john.relationships.iter_edges())
+        self.assertEqual([(f, t) for f, t, s, created in edges],
+                         [(self.john.pk, self.paul.pk), (self.john.pk, self.yoko.pk)])
+        self.assertEqual(list(self.walrus.relationships.iter_edges()), [])
+
+    def test_import_command(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'edges.csv')
+            with open(path, 'w') as f:
+                f.write('from_user,to_user,status\n'
+                        'The_Walrus,John,\n'
+                        'John,Paul,following\n'
+                        'Nobody,John,\n'
+                        'The_Walrus,Paul,blocking\n'
+                        'The_Walrus,John,following\n'
+                        'John,The_Walrus,\n')
+
+            out = StringIO()
+            with self.settings(RELATIONSHIPS_COUNTERS=True, RELATIONSHIPS_SYMMETRICAL_FLAG=True):
+                RelationshipCount.objects.rebuild()
+                call_command('import_relationships', path, batch_size=4, stdout=out)
+            self.assertEqual(out.getvalue(), 'Read 4, imported 2 relationships\n'
+                             'Read 6, imported 3 relationships\n'
+                             'Imported 3 of 6 relationships\n')
+
+            self.assertQuerysetEqual(self.walrus.relationships.following(), [self.john])
+            self.assertQuerysetEqual(self.walrus.relationships.blocking(), [self.paul])
+            self.assertQuerysetEqual(self.john.relationships.friends(), [self.walrus, self.yoko])
+            self.assertTrue(Relationship.objects.get(from_user=self.walrus, to_user=self.john,
+                                                     status=self.following).symmetrical)
+            self.assertEqual(RelationshipCount.objects.get(user=self.john, status=self.following,
+                                                           direction='to', site=1).count, 2)
+
+            # an interrupted import resumes after the last batch recorded
+            path = os.path.join(tmp_dir, 'edges.jsonl')
+            first = '{"from_user": "Paul", "to_user": "John"}\n'
+            with open(path, 'w') as f:
+                f.write(first + '{"from_user": "Paul", "to_user": "Yoko"}\n')
+            watermark = os.path.join(tmp_dir, 'import.json')
+            with open(watermark, 'w') as f:
+                json.dump({'offset': len(first), 'read': 1, 'imported': 1}, f)
+            out = StringIO()
+            call_command('import_relationships', path, watermark=watermark, stdout=out)
+            self.assertEqual(out.getvalue(), 'Resuming from byte 41\n'
+                             'Read 2, imported 2 relationships\n'
+                             'Imported 2 of 2 relationships\n')
+            self.assertFalse(os.path.exists(watermark))
+            self.assertQuerysetEqual(self.paul.relationships.following(), [self.yoko])
+
+            # statuses are only mutually exclusive with the listener attached
+            path = os.path.join(tmp_dir, 'blocking.csv')
+            with open(path, 'w') as f:
+                f.write('from_user,to_user,status\n'
+                        'John,Paul,blocking\n')
+            call_command('import_relationships', path, stdout=StringIO())
+            self.assertQuerysetEqual(self.john.relationships.following(),
+                                     [self.walrus, self.paul, self.yoko])
+            self.assertQuerysetEqual(self.john.relationships.blocking(), [self.paul])
+
+            # the later of two conflicting relationships wins, and existing
+            # relationships conflicting with imported ones are deleted
+            path = os.path.join(tmp_dir, 'exclusive.csv')
+            with open(path, 'w') as f:
+                f.write('from_user,to_user,status\n'
+                        'The_Walrus,Paul,blocking\n'
+                        'The_Walrus,Paul,following\n'
+                        'Paul,Yoko,blocking\n')
+            out = StringIO()
+            attach_relationship_listener()
+            try:
+                call_command('import_relationships', path, stdout=out)
+            finally:
+                detach_relationship_listener()
+            self.assertEqual(out.getvalue(), 'Read 3, imported 2 relationships\n'
+                             'Imported 2 of 3 relationships\n')
+            self.assertEqual(sorted(self.walrus.relationships.following_ids()),
+                             [self.john.pk, self.paul.pk])
+            self.assertQuerysetEqual(self.walrus.relationships.blocking(), [])
+            self.assertQuerysetEqual(self.paul.relationships.following(), [])
+            self.assertQuerysetEqual(self.paul.relationships.blocking(), [self.john, self.yoko])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_friends_self_join(self):
+        sql = str(self.john.relationships.friends().query)
+        self.assertTrue('INNER JOIN "relationships_relationship" "r2"' in sql)
+        self.assertFalse('"auth_user" INNER JOIN' in sql)
+
+        # still correct when used as a subquery
+        friends_of_john = User.objects.filter(pk__in=self.john.relationships.friends())
+        self.assertQuerysetEqual(friends_of_john, [self.yoko])
+
+    def test_id_querysets(self):
+        self.assertEqual(sorted(self.john.relationships.following_ids()), [self.paul.pk, self.yoko.pk])
+        self.assertEqual(list(self.john.relationships.followers_ids()), [self.yoko.pk])
+        self.assertEqual(list(self.john.relationships.friends_ids()), [self.yoko.pk])
+        self.assertEqual(list(self.paul.relationships.blocking_ids()), [self.john.pk])
+        self.assertEqual(list(self.john.relationships.blockers_ids()), [self.paul.pk])
+        self.assertEqual(list(self.walrus.relationships.friends_ids()), [])
+
+        for ids in (self.john.relationships.following_ids(),
+                    self.john.relationships.friends_ids()):
+            self.assertFalse('auth_user' in str(ids.query))
+
+        with self.settings(RELATIONSHIPS_SYMMETRICAL_FLAG=True):
+            rebuild_symmetrical_flags()
+            friends = self.john.relationships.friends_ids()
+            self.assertEqual(list(friends), [self.yoko.pk])
+            self.assertTrue('symmetrical' in str(friends.query))
+
+        # usable as a subquery
+        self.assertQuerysetEqual(
+            User.objects.filter(pk__in=self.john.relationships.following_ids()),
+            [self.paul, self.yoko])
+
     def test_custom_methods(self):
         rel = self.john.relationships.following()
         self.assertQuerysetEqual(rel, [self.paul, self.yoko])
@@ -241,6 +730,23 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         self.assertFalse(self.paul.relationships.exists(self.yoko, self.blocking))
         self.assertFalse(self.paul.relationships.exists(self.walrus, self.blocking))
 
+    def test_bulk_exists(self):
+        everyone = [self.walrus, self.john, self.paul, self.yoko]
+
+        self.assertEqual(self.john.relationships.bulk_exists(everyone), set([3, 4]))
+        self.assertEqual(self.john.relationships.bulk_exists(everyone, self.blocking), set())
+        self.assertEqual(self.john.relationships.bulk_exists(everyone, symmetrical=True), set([3, 4]))
+        self.assertEqual(self.john.relationships.bulk_exists(everyone, self.following, True), set([4]))
+        self.assertEqual(self.paul.relationships.bulk_exists(everyone, self.blocking), set([2]))
+
+        # ids work as well as user objects
+        self.assertEqual(self.john.relationships.bulk_exists([1, 2, 3]), set([3]))
+        self.assertEqual(self.john.relationships.bulk_exists([]), set())
+
+        self.assertEqual(self.john.relationships.bulk_related_to(everyone), set([3, 4]))
+        self.assertEqual(self.john.relationships.bulk_related_to(everyone, self.following), set([4]))
+        self.assertEqual(self.john.relationships.bulk_related_to(everyone, self.blocking), set([3]))
+
     def test_oneway_methods(self):
         self.assertQuerysetEqual(self.john.relationships.only_from(self.following), [self.paul])
         self.assertQuerysetEqual(self.john.relationships.only_to(self.following), [])
@@ -248,6 +754,65 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         self.assertQuerysetEqual(self.john.relationships.only_from(self.blocking), [])
         self.assertQuerysetEqual(self.john.relationships.only_to(self.blocking), [self.paul])
 
+    def test_oneway_methods_use_not_exists(self):
+        qs = self.john.relationships.only_from(self.following)
+        sql = str(qs.query)
+        self.assertTrue('NOT (EXISTS (SELECT 1 FROM' in sql)
+        self.assertFalse(' IN (' in sql)
+
+        # the correlated subquery still works when nested in another query
+        yoko_fans = User.objects.filter(pk__in=self.yoko.relationships.only_to(self.following))
+        self.assertQuerysetEqual(yoko_fans, [])
+        self.john.relationships.remove(self.yoko)
+        yoko_fans = User.objects.filter(pk__in=self.yoko.relationships.only_from(self.following))
+        self.assertQuerysetEqual(yoko_fans, [self.john])
+
+    def test_difference_and_intersection(self):
+        rel = self.john.relationships.difference('following', 'followers')
+        self.assertQuerysetEqual(rel, [self.paul])
+
+        rel = self.john.relationships.difference('followers', 'following')
+        self.assertQuerysetEqual(rel, [])
+
+        rel = self.john.relationships.difference('following', 'friends')
+        self.assertQuerysetEqual(rel, [self.paul])
+
+        rel = self.john.relationships.difference('following', 'blockers')
+        self.assertQuerysetEqual(rel, [self.yoko])
+
+        rel = self.john.relationships.difference('following', 'blockers', 'followers')
+        self.assertQuerysetEqual(rel, [])
+
+        rel = self.john.relationships.intersection('following', 'followers')
+        self.assertQuerysetEqual(rel, [self.yoko])
+
+        rel = self.john.relationships.intersection('following', 'blockers')
+        self.assertQuerysetEqual(rel, [self.paul])
+
+        rel = self.john.relationships.intersection('friends', 'blockers')
+        self.assertQuerysetEqual(rel, [])
+
+        rel = self.john.relationships.intersection('following')
+        self.assertQuerysetEqual(rel, [self.paul, self.yoko])
+
+    def test_combined_filters(self):
+        # combining relabels the right hand QuerySet's clauses on a copy,
+        # leaving both QuerySets as they were
+        only_following = self.john.relationships.difference('following', 'followers')
+        friends = self.john.relationships.get_relationships(self.following, symmetrical=True)
+        sql = str(friends.query)
+        self.assertQuerysetEqual(only_following | friends, [self.paul, self.yoko])
+        self.assertQuerysetEqual(friends | only_following, [self.paul, self.yoko])
+        self.assertEqual(str(friends.query), sql)
+        self.assertQuerysetEqual(friends, [self.yoko])
+        self.assertQuerysetEqual(only_following, [self.paul])
+
+        node = RelationshipExists('auth_user', 'id', self.john.pk, self.following.pk,
+                                  1, ('from',))
+        clone = node.relabeled_clone({'auth_user': 'T3'})
+        self.assertEqual((node.alias, clone.alias), ('auth_user', 'T3'))
+        self.assertEqual(clone.directions, node.directions)
+
     def test_site_behavior(self):
         # relationships are site-dependent
 
@@ -273,6 +838,519 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         self.walrus.relationships.remove(self.paul)
         self.assertQuerysetEqual(self.walrus.relationships.all(), [self.john, self.paul])
 
+    def test_current_site(self):
+        RelationshipStatus.objects.following()
+        Site.objects.clear_cache()
+
+        # the site isn't looked up when adding relationships
+        self.assertNumQueries(2, self.walrus.relationships.add, self.john)
+
+        set_current_site_id(self.second_site.pk)
+        try:
+            self.walrus.relationships.add(self.paul)
+            self.assertQuerysetEqual(self.walrus.relationships.following(), [self.paul])
+            self.assertQuerysetEqual(self.john.relationships.following(), [])
+            self.assertEqual(Relationship.objects.get(
+                from_user=self.walrus, to_user=self.paul).site, self.second_site)
+        finally:
+            clear_current_site_id()
+
+        self.assertQuerysetEqual(self.walrus.relationships.following(), [self.john])
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.paul, self.yoko])
+
+    def test_current_site_middleware(self):
+        class FakeRequest(object):
+            site = self.second_site
+
+        middleware = CurrentSiteMiddleware()
+        request = FakeRequest()
+
+        middleware.process_request(request)
+        self.assertEqual(get_current_site_id(), self.second_site.pk)
+        self.assertQuerysetEqual(self.john.relationships.following(), [])
+
+        response = object()
+        self.assertEqual(middleware.process_response(request, response), response)
+        self.assertEqual(get_current_site_id(), settings.SITE_ID)
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.paul, self.yoko])
+
+
+class RelationshipStatusCacheTestCase(BaseRelationshipsTestCase):
+    def test_cached_lookups(self):
+        RelationshipStatus.objects.clear_cache()
+
+        # the first lookup loads every status in a single query
+        self.assertNumQueries(1, RelationshipStatus.objects.following)
+
+        self.assertNumQueries(0, RelationshipStatus.objects.blocking)
+        self.assertEqual(RelationshipStatus.objects.following(), self.following)
+        self.assertEqual(RelationshipStatus.objects.blocking(), self.blocking)
+
+        # lookups by any of the slugs or by pk are served from the registry
+        self.assertNumQueries(0, RelationshipStatus.objects.by_slug, 'friends')
+        self.assertEqual(RelationshipStatus.objects.by_slug('following'), self.following)
+        self.assertEqual(RelationshipStatus.objects.by_slug('followers'), self.following)
+        self.assertEqual(RelationshipStatus.objects.by_slug('friends'), self.following)
+        self.assertEqual(RelationshipStatus.objects.by_slug('blockers'), self.blocking)
+        self.assertEqual(RelationshipStatus.objects.get_cached(self.blocking.pk), self.blocking)
+
+        self.assertRaises(RelationshipStatus.DoesNotExist,
+            RelationshipStatus.objects.by_slug, 'walrus-friends')
+        self.assertRaises(RelationshipStatus.DoesNotExist,
+            RelationshipStatus.objects.get_cached, 1000)
+
+    def test_cache_invalidation(self):
+        RelationshipStatus.objects.following()
+
+        # saving a status clears the registry
+        enemies = RelationshipStatus.objects.create(
+            name='Enemies',
+            verb='hate',
+            from_slug='enemies-with',
+            to_slug='disliked-by',
+            symmetrical_slug='mutually-dislike')
+        self.assertEqual(RelationshipStatus.objects.by_slug('disliked-by'), enemies)
+
+        enemies.from_slug = 'hating'
+        enemies.save()
+        self.assertEqual(RelationshipStatus.objects.by_slug('hating'), enemies)
+        self.assertRaises(RelationshipStatus.DoesNotExist,
+            RelationshipStatus.objects.by_slug, 'enemies-with')
+
+        # ...as does deleting one
+        enemies.delete()
+        self.assertRaises(RelationshipStatus.DoesNotExist,
+            RelationshipStatus.objects.by_slug, 'hating')
+
+        # a slug shared by several statuses is ambiguous, as it was with get()
+        RelationshipStatus.objects.create(
+            name='Fans',
+            verb='admire',
+            from_slug='admiring',
+            to_slug='followers',
+            symmetrical_slug='mutual-fans')
+        self.assertRaises(RelationshipStatus.MultipleObjectsReturned,
+            RelationshipStatus.objects.by_slug, 'followers')
+
+
+class RelationshipEdgeCacheTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        cache.clear()
+
+        # make sure statuses are loaded so they don't count towards queries
+        RelationshipStatus.objects.following()
+
+    def tearDown(self):
+        cache.clear()
+        BaseRelationshipsTestCase.tearDown(self)
+
+    def test_exists_is_cached(self):
+        self.assertNumQueries(1, self.john.relationships.exists, self.yoko)
+        self.assertNumQueries(0, self.john.relationships.exists, self.yoko)
+
+        self.assertTrue(self.john.relationships.exists(self.yoko))
+        self.assertTrue(self.john.relationships.exists(self.yoko, self.following))
+        self.assertFalse(self.john.relationships.exists(self.yoko, self.blocking))
+
+        # both directions are loaded with one query
+        self.assertNumQueries(1, self.john.relationships.exists, self.paul, symmetrical=True)
+        self.assertNumQueries(0, self.paul.relationships.exists, self.john)
+
+        self.assertTrue(self.john.relationships.exists(self.paul, symmetrical=True))
+        self.assertFalse(self.john.relationships.exists(self.paul, self.following, True))
+        self.assertTrue(self.john.relationships.exists(self.yoko, self.following, True))
+        self.assertTrue(self.paul.relationships.exists(self.john, self.blocking))
+        self.assertFalse(self.paul.relationships.exists(self.john, self.following))
+
+        # missing relationships are cached too
+        self.assertFalse(self.john.relationships.exists(self.walrus))
+        self.assertNumQueries(0, self.john.relationships.exists, self.walrus)
+
+    def test_cache_invalidation(self):
+        self.assertFalse(self.john.relationships.exists(self.walrus))
+
+        self.john.relationships.add(self.walrus)
+        self.assertTrue(self.john.relationships.exists(self.walrus))
+
+        # the cache is bypassed until the change is committed
+        self.assertNumQueries(1, self.john.relationships.exists, self.walrus)
+        self.commit()
+        self.assertTrue(self.john.relationships.exists(self.walrus))
+        self.assertNumQueries(0, self.john.relationships.exists, self.walrus)
+
+        self.john.relationships.remove(self.walrus)
+        self.assertFalse(self.john.relationships.exists(self.walrus))
+
+        self.assertTrue(relationship_exists(self.john, self.yoko, 'friends'))
+        self.yoko.relationships.remove(self.john)
+        self.assertFalse(relationship_exists(self.john, self.yoko, 'friends'))
+
+RelationshipEdgeCacheTestCase = override_settings(
+    RELATIONSHIPS_CACHE_ALIAS='default')(RelationshipEdgeCacheTestCase)
+
+
+class RelationshipCountTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        RelationshipCount.objects.rebuild()
+
+    def assertCounts(self, user, following, followers):
+        self.assertEqual(user.relationships.following_count(), following)
+        self.assertEqual(user.relationships.followers_count(), followers)
+
+    def test_rebuild(self):
+        self.assertCounts(self.walrus, 0, 0)
+        self.assertCounts(self.john, 2, 1)
+        self.assertCounts(self.paul, 0, 1)
+        self.assertCounts(self.yoko, 1, 1)
+
+        self.assertEqual(self.paul.relationships.get_count(self.blocking, 'from'), 1)
+        self.assertEqual(self.john.relationships.get_count(self.blocking, 'to'), 1)
+
+        RelationshipCount.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_relationship_counts', stdout=out)
+        self.assertEqual(out.getvalue(), 'Rebuilt 7 relationship counters\n')
+        self.assertCounts(self.john, 2, 1)
+
+    def test_counts_are_read_from_the_counters(self):
+        RelationshipStatus.objects.following()
+        self.assertNumQueries(1, self.john.relationships.following_count)
+
+    def test_add_and_remove(self):
+        self.walrus.relationships.add(self.john)
+        self.assertCounts(self.walrus, 1, 0)
+        self.assertCounts(self.john, 2, 2)
+
+        # adding a relationship twice doesn't change the counts
+        self.walrus.relationships.add(self.john)
+        self.assertCounts(self.john, 2, 2)
+
+        self.walrus.relationships.remove(self.john)
+        self.assertCounts(self.walrus, 0, 0)
+        self.assertCounts(self.john, 2, 1)
+
+        self.walrus.relationships.add(self.paul, symmetrical=True)
+        self.assertCounts(self.walrus, 1, 1)
+        self.assertCounts(self.paul, 1, 2)
+
+    def test_delete_user(self):
+        yoko_pk = self.yoko.pk
+        self.yoko.delete()
+        self.assertCounts(self.john, 1, 0)
+        self.assertCounts(self.paul, 0, 1)
+        self.assertFalse(RelationshipCount.objects.filter(user=yoko_pk).exists())
+        self.assertFalse(RelationshipCount.objects.filter(count__lt=0).exists())
+
+        # counters which don't exist are never created to go negative
+        RelationshipCount.objects.all().delete()
+        self.john.relationships.remove(self.paul)
+        self.assertFalse(RelationshipCount.objects.exists())
+
+    def test_add_many_and_remove_many(self):
+        self.walrus.relationships.add_many([self.john, self.paul, self.yoko])
+        self.assertCounts(self.walrus, 3, 0)
+        self.assertCounts(self.john, 2, 2)
+        self.assertCounts(self.paul, 0, 2)
+        self.assertCounts(self.yoko, 1, 2)
+
+        self.walrus.relationships.remove_many([self.john, self.paul], symmetrical=True)
+        self.assertCounts(self.walrus, 1, 0)
+        self.assertCounts(self.john, 2, 1)
+        self.assertCounts(self.paul, 0, 1)
+
+    def test_status_change(self):
+        relationship = Relationship.objects.get(from_user=self.john, to_user=self.paul,
+                                                status=self.following)
+        relationship.status = self.blocking
+        relationship.save()
+        self.assertCounts(self.john, 1, 1)
+        self.assertCounts(self.paul, 0, 0)
+        self.assertEqual(self.john.relationships.get_count(self.blocking, 'from'), 1)
+        self.assertEqual(self.paul.relationships.get_count(self.blocking, 'to'), 1)
+
+        # saving it again doesn't move it twice
+        relationship.save()
+        self.assertCounts(self.john, 1, 1)
+        self.assertEqual(self.john.relationships.get_count(self.blocking, 'from'), 1)
+
+RelationshipCountTestCase = override_settings(
+    RELATIONSHIPS_COUNTERS=True)(RelationshipCountTestCase)
+
+
+class RelationshipSymmetricalFlagTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        out = StringIO()
+        call_command('rebuild_symmetrical_flags', stdout=out)
+        self.assertEqual(out.getvalue(), '2 relationships are symmetrical\n')
+
+    def assertSymmetrical(self, from_user, to_user, symmetrical=True):
+        self.assertEqual(Relationship.objects.get(
+            from_user=from_user, to_user=to_user, status=self.following
+        ).symmetrical, symmetrical)
+
+    def test_rebuild(self):
+        self.assertSymmetrical(self.john, self.yoko)
+        self.assertSymmetrical(self.yoko, self.john)
+        self.assertSymmetrical(self.john, self.paul, False)
+
+        Relationship.objects.update(symmetrical=True)
+        rebuild_symmetrical_flags()
+        self.assertSymmetrical(self.john, self.paul, False)
+        self.assertSymmetrical(self.john, self.yoko)
+
+    def test_friends_read_the_flag(self):
+        self.assertTrue('"r1"."symmetrical" = ' in str(self.john.relationships.friends().query))
+        self.assertQuerysetEqual(self.john.relationships.friends(), [self.yoko])
+        self.assertQuerysetEqual(self.yoko.relationships.friends(), [self.john])
+        self.assertQuerysetEqual(self.paul.relationships.friends(), [])
+
+    def test_add_and_remove(self):
+        self.paul.relationships.add(self.john)
+        self.assertSymmetrical(self.paul, self.john)
+        self.assertSymmetrical(self.john, self.paul)
+        self.assertQuerysetEqual(self.john.relationships.friends(), [self.paul, self.yoko])
+
+        self.john.relationships.remove(self.yoko)
+        self.assertSymmetrical(self.yoko, self.john, False)
+        self.assertQuerysetEqual(self.john.relationships.friends(), [self.paul])
+        self.assertQuerysetEqual(self.yoko.relationships.friends(), [])
+
+        self.walrus.relationships.add(self.john, symmetrical=True)
+        self.assertQuerysetEqual(self.walrus.relationships.friends(), [self.john])
+
+    def test_add_many(self):
+        self.john.relationships.add_many([self.walrus, self.paul])
+        self.assertSymmetrical(self.john, self.walrus, False)
+
+        self.walrus.relationships.add_many([self.john, self.paul, self.yoko])
+        self.assertSymmetrical(self.john, self.walrus)
+        self.assertSymmetrical(self.walrus, self.john)
+        self.assertSymmetrical(self.walrus, self.paul, False)
+        self.assertQuerysetEqual(self.walrus.relationships.friends(), [self.john])
+
+        self.paul.relationships.add_many([self.walrus, self.yoko], symmetrical=True)
+        self.assertQuerysetEqual(self.paul.relationships.friends(), [self.walrus, self.yoko])
+        self.assertQuerysetEqual(self.walrus.relationships.friends(), [self.john, self.paul])
+
+    def test_status_change(self):
+        relationship = Relationship.objects.get(from_user=self.john, to_user=self.yoko,
+                                                status=self.following)
+        relationship.status = self.blocking
+        relationship.save()
+        self.assertSymmetrical(self.yoko, self.john, False)
+        self.assertFalse(Relationship.objects.get(pk=relationship.pk).symmetrical)
+        self.assertQuerysetEqual(self.yoko.relationships.friends(), [])
+
+        # paul blocks john, so john blocking paul reciprocates it
+        relationship = Relationship.objects.get(from_user=self.john, to_user=self.paul,
+                                                status=self.following)
+        relationship.status = self.blocking
+        relationship.save()
+        self.assertTrue(Relationship.objects.get(pk=relationship.pk).symmetrical)
+        self.assertTrue(Relationship.objects.get(from_user=self.paul, to_user=self.john,
+                                                 status=self.blocking).symmetrical)
+
+RelationshipSymmetricalFlagTestCase = override_settings(
+    RELATIONSHIPS_SYMMETRICAL_FLAG=True)(RelationshipSymmetricalFlagTestCase)
+
+
+class RelationshipEventTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        self.received = []
+        self.delivered = threading.Event()
+        relationship_event.connect(self.receive)
+
+    def tearDown(self):
+        relationship_event.disconnect(self.receive)
+        BaseRelationshipsTestCase.tearDown(self)
+
+    def receive(self, sender, event, **kwargs):
+        self.received.append((event.event, event.from_user_id, event.to_user_id,
+                              event.status_id, event.old_status_id))
+        self.delivered.set()
+
+    def test_queue_backend(self):
+        with self.settings(RELATIONSHIPS_EVENT_BACKEND='relationships.events.QueueBackend'):
+            self.paul.relationships.add(self.john)
+            self.john.relationships.remove(self.yoko)
+            self.walrus.relationships.add_many([self.john, self.paul])
+
+            relationship = Relationship.objects.get(from_user=self.walrus, to_user=self.john)
+            relationship.status = self.blocking
+            relationship.save()
+            relationship.save()
+
+        self.assertEqual(self.received, [])
+        self.assertEqual(RelationshipEvent.objects.count(), 5)
+
+        out = StringIO()
+        call_command('drain_relationship_events', batch_size=2, stdout=out)
+        self.assertEqual(out.getvalue(), 'Delivered 5 relationship events\n')
+        self.assertEqual(RelationshipEvent.objects.count(), 0)
+
+        f, b = self.following.pk, self.blocking.pk
+        self.assertEqual(self.received, [
+            ('created', self.paul.pk, self.john.pk, f, None),
+            ('deleted', self.john.pk, self.yoko.pk, f, None),
+            ('created', self.walrus.pk, self.john.pk, f, None),
+            ('created', self.walrus.pk, self.paul.pk, f, None),
+            ('status_changed', self.walrus.pk, self.john.pk, b, f),
+        ])
+
+    def test_drain_failures(self):
+        def fail(sender, event, **kwargs):
+            if event.to_user_id == self.yoko.pk:
+                raise ValueError('receiver failed')
+        relationship_event.connect(fail)
+
+        try:
+            with self.settings(RELATIONSHIPS_EVENT_BACKEND='relationships.events.QueueBackend'):
+                self.walrus.relationships.add_many([self.john, self.yoko, self.paul])
+
+            # the failing event does not hold back the others, and is tried
+            # again until it runs out of attempts
+            out = StringIO()
+            call_command('drain_relationship_events', max_attempts=3, stdout=out)
+            self.assertEqual(out.getvalue(), 'Delivered 2 relationship events\n'
+                             'Gave up on 1 relationship events\n')
+            john, paul, yoko = self.john.pk, self.paul.pk, self.yoko.pk
+            self.assertEqual(sorted(event[2] for event in self.received),
+                             sorted([john, paul, yoko, yoko, yoko]))
+            self.assertEqual(list(RelationshipEvent.objects.values_list('to_user_id', 'attempts')),
+                             [(self.yoko.pk, 3)])
+
+            relationship_event.disconnect(fail)
+            out = StringIO()
+            call_command('drain_relationship_events', max_attempts=4, stdout=out)
+            self.assertEqual(out.getvalue(), 'Delivered 1 relationship events\n')
+            self.assertEqual(RelationshipEvent.objects.count(), 0)
+        finally:
+            relationship_event.disconnect(fail)
+
+
+class RelationshipsTransactionTestCase(TransactionTestCase):
+    """
+    Behavior which waits for transactions to really commit: delivery by the
+    sync and thread backends and the status and edge caches.
+    """
+    fixtures = ['relationships.json']
+
+    def setUp(self):
+        self.walrus = User.objects.get(username='The_Walrus')
+        self.john = User.objects.get(username='John')
+        self.paul = User.objects.get(username='Paul')
+        self.yoko = User.objects.get(username='Yoko')
+        self.following = RelationshipStatus.objects.get(from_slug='following')
+        self.received = []
+        self.delivered = threading.Event()
+        relationship_event.connect(self.receive)
+
+    def tearDown(self):
+        relationship_event.disconnect(self.receive)
+
+    def receive(self, sender, event, **kwargs):
+        self.received.append((event.event, event.from_user_id, event.to_user_id,
+                              event.status_id, event.old_status_id))
+        self.delivered.set()
+
+    def test_sync_backend(self):
+        with self.settings(RELATIONSHIPS_EVENT_BACKEND='relationships.events.SyncBackend'):
+            self.paul.relationships.add(self.john)
+            self.assertEqual(self.received, [
+                ('created', self.paul.pk, self.john.pk, self.following.pk, None)])
+
+            # delivery waits for the commit of the atomic block...
+            def add_and_check():
+                self.walrus.relationships.add(self.john)
+                self.assertEqual(len(self.received), 1)
+            atomic(add_and_check)()
+            self.assertEqual(len(self.received), 2)
+
+            # ...or of a transaction managed by other means, in which an
+            # atomic block only runs its function
+            @transaction.commit_on_success
+            def add_in_managed():
+                atomic(self.walrus.relationships.add)(self.yoko)
+                self.assertEqual(len(self.received), 2)
+            add_in_managed()
+            self.assertEqual(len(self.received), 3)
+
+            # and nothing is delivered for a transaction which rolls back
+            @transaction.commit_on_success
+            def fail():
+                self.walrus.relationships.add(self.paul)
+                raise ValueError
+            self.assertRaises(ValueError, fail)
+            self.assertFalse(self.walrus.relationships.following().filter(pk=self.paul.pk).exists())
+            self.assertEqual([event[2] for event in self.received],
+                             [self.john.pk, self.john.pk, self.yoko.pk])
+
+    def test_status_cache_rollback(self):
+        RelationshipStatus.objects.following()
+
+        @transaction.commit_on_success
+        def create():
+            RelationshipStatus.objects.create(
+                name='Muting', verb='mute', from_slug='muting',
+                to_slug='muted-by', symmetrical_slug='mutually-muting')
+            self.assertEqual(RelationshipStatus.objects.by_slug('muting').name, 'Muting')
+            raise ValueError
+        self.assertRaises(ValueError, create)
+
+        # the status read inside the transaction was not kept
+        self.assertRaises(RelationshipStatus.DoesNotExist,
+            RelationshipStatus.objects.by_slug, 'muting')
+
+        # a committed status is seen once the transaction commits, even by
+        # a registry loaded in the meantime
+        @transaction.commit_on_success
+        def create_and_commit():
+            RelationshipStatus.objects.create(
+                name='Muting', verb='mute', from_slug='muting',
+                to_slug='muted-by', symmetrical_slug='mutually-muting')
+            _status_cache['default'] = RelationshipStatus.objects._load_cache()
+        create_and_commit()
+        self.assertEqual(RelationshipStatus.objects.by_slug('muting').name, 'Muting')
+        self.assertNumQueries(0, RelationshipStatus.objects.by_slug, 'muting')
+
+    def test_edge_cache_rollback(self):
+        cache.clear()
+        with self.settings(RELATIONSHIPS_CACHE_ALIAS='default'):
+            @transaction.commit_on_success
+            def add():
+                self.walrus.relationships.add(self.paul)
+                self.assertTrue(self.walrus.relationships.exists(self.paul))
+                raise ValueError
+            self.assertRaises(ValueError, add)
+
+            # the relationship seen inside the transaction was not cached
+            self.assertFalse(self.walrus.relationships.exists(self.paul))
+
+            # an edge cached by another thread before the commit is deleted
+            @transaction.commit_on_success
+            def add_and_commit():
+                self.walrus.relationships.add(self.paul)
+                get_edge_cache().set_many({(self.walrus.pk, self.paul.pk): ()}, 1)
+            add_and_commit()
+            self.assertTrue(self.walrus.relationships.exists(self.paul))
+        cache.clear()
+
+    def test_thread_backend(self):
+        with self.settings(RELATIONSHIPS_EVENT_BACKEND='relationships.events.ThreadBackend'):
+            @transaction.commit_on_success
+            def add():
+                self.paul.relationships.add(self.john)
+                self.assertFalse(self.delivered.wait(0.1))
+            add()
+
+        self.delivered.wait(5)
+        self.assertEqual(self.received, [
+            ('created', self.paul.pk, self.john.pk, self.following.pk, None)])
+
 
 class RelationshipsListenersTestCase(BaseRelationshipsTestCase):
     def setUp(self):
@@ -300,6 +1378,55 @@ class RelationshipsListenersTestCase(BaseRelationshipsTestCase):
         self.assertQuerysetEqual(self.paul.relationships.following(), [self.john])
         self.assertQuerysetEqual(self.paul.relationships.blocking(), [])
 
+    def test_following_and_blocking_many(self):
+        # when john blocks everybody his 'following' relationships are deleted
+        self.john.relationships.add_many([self.walrus, self.paul, self.yoko], self.blocking)
+        self.assertQuerysetEqual(self.john.relationships.blocking(), [self.walrus, self.paul, self.yoko])
+        self.assertQuerysetEqual(self.john.relationships.following(), [])
+
+        # yoko's relationship to john is untouched
+        self.assertQuerysetEqual(self.yoko.relationships.following(), [self.john])
+
+        # when everybody follows paul his 'blocking' relationship is deleted
+        self.paul.relationships.add_many([self.walrus, self.john], self.following, symmetrical=True)
+        self.assertQuerysetEqual(self.paul.relationships.blocking(), [])
+        self.assertQuerysetEqual(self.paul.relationships.friends(), [self.walrus, self.john])
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.paul])
+        self.assertQuerysetEqual(self.john.relationships.blocking(), [self.walrus, self.yoko])
+
+    def test_mutually_exclusive_queries(self):
+        self.assertEqual(get_mutually_exclusive_statuses(), {
+            self.following.pk: [self.blocking], self.blocking.pk: [self.following]})
+
+        # get_or_create, then one select and one delete for the conflicting
+        # relationship, with the statuses never loaded
+        self.assertNumQueries(4, self.john.relationships.add, self.paul, self.blocking)
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.yoko])
+
+        # saving an existing relationship (a select and an update) does not
+        # look for conflicts
+        relationship = Relationship.objects.get(from_user=self.john, to_user=self.yoko)
+        self.assertNumQueries(2, relationship.save)
+
+    def test_mutually_exclusive_setting(self):
+        friends = RelationshipStatus.objects.create(
+            name='Friends', verb='friends with', from_slug='friends-with',
+            to_slug='friended-by', symmetrical_slug='friended')
+
+        with self.settings(RELATIONSHIPS_MUTUALLY_EXCLUSIVE=[('friends-with', 'blocking')]):
+            self.john.relationships.add(self.paul, friends)
+            self.john.relationships.add(self.paul, self.blocking)
+            self.assertQuerysetEqual(self.john.relationships.get_relationships(friends), [])
+
+            # following and blocking may coexist now
+            self.assertQuerysetEqual(self.john.relationships.following(), [self.paul, self.yoko])
+
+        # statuses are named by from_slug only
+        with self.settings(RELATIONSHIPS_MUTUALLY_EXCLUSIVE=[('friended-by', 'blocking')]):
+            self.assertRaises(ImproperlyConfigured, get_mutually_exclusive_statuses)
+        with self.settings(RELATIONSHIPS_MUTUALLY_EXCLUSIVE=[('walrus-friends', 'blocking')]):
+            self.assertRaises(ImproperlyConfigured, get_mutually_exclusive_statuses)
+
     def test_listener_disconnecting(self):
         # this test simply ensures the default behavior
         detach_relationship_listener()
@@ -363,6 +1490,72 @@ class RelationshipsViewsTestCase(BaseRelationshipsTestCase):
         resp = self.client.get(url)
         self.assertEqual(resp.status_code, 404)
 
+    def test_cursor_list_views(self):
+        from relationships import views
+        page_size = views.CURSOR_PAGE_SIZE
+        views.CURSOR_PAGE_SIZE = 2
+
+        try:
+            # relationships created in the same instant are ordered by id
+            fans = [User.objects.create(username='fan%d' % i) for i in range(4)]
+            for fan in fans:
+                fan.relationships.add(self.john)
+
+            url = reverse('relationship_list', args=['John', 'followers'])
+            resp = self.client.get(url, {'cursor': ''})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.context['relationship_list'], [fans[3], fans[2]])
+
+            resp = self.client.get(url, {'cursor': resp.context['next_cursor']})
+            self.assertEqual(resp.context['relationship_list'], [fans[1], fans[0]])
+
+            resp = self.client.get(url, {'cursor': resp.context['next_cursor']})
+            self.assertEqual(resp.context['relationship_list'], [self.yoko])
+            self.assertEqual(resp.context['next_cursor'], None)
+
+            url = reverse('relationship_list', args=['John', 'following'])
+            resp = self.client.get(url, {'cursor': ''})
+            self.assertEqual(resp.context['relationship_list'], [self.yoko, self.paul])
+            self.assertEqual(resp.context['next_cursor'], None)
+
+            url = reverse('relationship_list', args=['John', 'friends'])
+            resp = self.client.get(url, {'cursor': ''})
+            self.assertEqual(resp.context['relationship_list'], [self.yoko])
+
+            # a bogus cursor is a 404
+            resp = self.client.get(url, {'cursor': 'walrus'})
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            views.CURSOR_PAGE_SIZE = page_size
+
+    def test_export_view(self):
+        url = reverse('relationship_export', args=['John'])
+        self.assertEqual(url, '/relationships/John/export.jsonl')
+        # and does not shadow the lists of a user named export
+        self.assertEqual(resolve('/relationships/export/following/').url_name, 'relationship_list')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 302)
+
+        # only the user and staff can export their relationships
+        self.client.login(username='John', password='John')
+        resp = self.client.get(reverse('relationship_export', args=['Paul']))
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        edges = [json.loads(line) for line in ''.join(resp).splitlines()]
+        self.assertEqual([(e['from_user'], e['to_user'], e['status']) for e in edges], [
+            (self.john.pk, self.paul.pk, 'following'),
+            (self.john.pk, self.yoko.pk, 'following'),
+            (self.yoko.pk, self.john.pk, 'following'),
+            (self.paul.pk, self.john.pk, 'blocking'),
+        ])
+
+        resp = self.client.get(url, {'direction': 'to', 'status': 'blocking'})
+        edges = [json.loads(line) for line in ''.join(resp).splitlines()]
+        self.assertEqual([(e['from_user'], e['to_user']) for e in edges], [(self.paul.pk, self.john.pk)])
+
     def test_add_remove_login_required(self):
         # login required
         url = reverse('relationship_add', args=['The_Walrus', 'following'])
@@ -521,6 +1714,31 @@ class RelationshipsTagsTestCase(BaseRelationshipsTestCase):
         rendered = t.render(c)
         self.assertEqual(rendered, 'y')
 
+    def test_prefetch_relationships_tag(self):
+        t = Template('{% load relationship_tags %}{% prefetch_relationships john users "following" %}'
+                     '{% for user in users %}{% if_relationship john user "following" %}y{% else %}n{% endif_relationship %}{% endfor %}')
+        users = [self.walrus, self.john, self.paul, self.yoko]
+        RelationshipStatus.objects.following()
+
+        c = Context({'john': self.john, 'users': users})
+        self.assertNumQueries(1, t.render, c)
+        self.assertEqual(t.render(c), 'nnyy')
+
+        t = Template('{% load relationship_tags %}{% prefetch_relationships john users "followers" %}'
+                     '{% for user in users %}{% if_relationship john user "followers" %}y{% else %}n{% endif_relationship %}{% endfor %}')
+        self.assertEqual(t.render(Context({'john': self.john, 'users': users})), 'nnny')
+
+        t = Template('{% load relationship_tags %}{% prefetch_relationships john users "friends" %}'
+                     '{% for user in users %}{% if_relationship john user "friends" %}y{% else %}n{% endif_relationship %}{% endfor %}')
+        self.assertEqual(t.render(Context({'john': self.john, 'users': users})), 'nnny')
+
+        # users that were not prefetched fall back to the database
+        t = Template('{% load relationship_tags %}{% prefetch_relationships john users "following" %}'
+                     '{% if_relationship john paul "following" %}y{% else %}n{% endif_relationship %}')
+        c = Context({'john': self.john, 'paul': self.paul, 'users': [self.walrus]})
+        self.assertNumQueries(2, t.render, c)
+        self.assertEqual(t.render(c), 'y')
+
     def test_status_filters(self):
         # create some groups to filter
         from django.contrib.auth.models import Group
@@ -581,6 +1799,28 @@ class RelationshipsTagsTestCase(BaseRelationshipsTestCase):
         rendered = t.render(c)
         self.assertEqual(rendered, 'beatles|')
 
+    def test_status_filters_reuse_lookups(self):
+        from django.contrib.auth.models import Group
+        from relationships.templatetags.relationship_tags import _model_cache
+        john_post = Post.objects.create(author=self.john)
+        paul_post = Post.objects.create(author=self.paul)
+
+        t = Template('{% load relationship_tags %}'
+                     '{% for p in "relationships_tests.post"|following_content:user %}{{ p.pk }}|{% endfor %}'
+                     '{% for p in "relationships_tests.post"|following_content:user %}{{ p.pk }}|{% endfor %}'
+                     '{% for p in "relationships_tests.post"|unblocked_content:user %}{{ p.pk }}|{% endfor %}'
+                     '{% for g in "auth.nothing"|friend_content:user %}{{ g.pk }}|{% endfor %}')
+        self.assertEqual(t.render(Context({'user': self.yoko})), '%d|%d|%d|%d|' % (
+            john_post.pk, john_post.pk, paul_post.pk, john_post.pk))
+
+        self.assertEqual(_model_cache['relationships_tests.post'], Post)
+        self.assertFalse('auth.nothing' in _model_cache)
+
+        # the relationships are tested within each filter's query, so
+        # rendering it again costs one query per loop over posts
+        self.assertNumQueries(3, t.render, Context({'user': self.yoko}))
+        self.assertFalse('_relationship_querysets' in self.yoko.__dict__)
+
 
 class RelationshipStatusAdminFormTestCase(BaseRelationshipsTestCase):
     def test_no_dupes(self):
@@ -645,6 +1885,29 @@ class RelationshipUtilsTestCase(BaseRelationshipsTestCase):
         self.assertEqual(extract_user_field(Comment), 'user')
         self.assertEqual(extract_user_field(Site), None)
 
+    def test_user_field_cache(self):
+        from django.contrib.auth.models import Group
+        clear_user_field_cache()
+        warm_user_field_cache()
+        self.assertEqual(_user_field_cache[Post], 'author')
+        self.assertEqual(_user_field_cache[Group], 'user')
+
+        # warm lookups do not touch the model's fields
+        Post.relationships_user_field = 'not-used'
+        try:
+            self.assertEqual(extract_user_field(Post), 'author')
+
+            # a declared field wins over inspection
+            clear_user_field_cache()
+            self.assertEqual(extract_user_field(Post), 'not-used')
+
+            clear_user_field_cache()
+            with self.settings(RELATIONSHIPS_USER_FIELDS={'relationships_tests.post': 'author__pk'}):
+                self.assertEqual(extract_user_field(Post), 'author__pk')
+        finally:
+            del Post.relationships_user_field
+            clear_user_field_cache()
+
     def test_positive_filter(self):
         following = RelationshipStatus.objects.following()
 
@@ -784,6 +2047,71 @@ class RelationshipUtilsTestCase(BaseRelationshipsTestCase):
             'user')
         self.assertQuerysetEqual(paul_blocking_groups, [beatles, characters, john_yoko])
 
+    def test_filters_use_exists(self):
+        walrus_post = Post.objects.create(author=self.walrus)
+        paul_post = Post.objects.create(author=self.paul)
+        yoko_post = Post.objects.create(author=self.yoko)
+        john_post = Post.objects.create(author=self.john)
+        post_qs = Post.objects.all()
+
+        following = positive_filter(post_qs, self.john.relationships.following(), 'author')
+        sql = str(following.query)
+        self.assertTrue('EXISTS' in sql)
+        self.assertFalse('DISTINCT' in sql)
+        self.assertQuerysetEqual(following, [yoko_post, paul_post])
+
+        # the user field is found automatically
+        self.assertQuerysetEqual(
+            positive_filter(post_qs, self.john.relationships.followers()), [yoko_post])
+        self.assertQuerysetEqual(
+            positive_filter(post_qs, self.yoko.relationships.friends()), [john_post])
+
+        unblocked = negative_filter(post_qs, self.paul.relationships.blocking(), 'author')
+        sql = str(unblocked.query)
+        self.assertTrue('NOT (EXISTS' in sql)
+        self.assertFalse('DISTINCT' in sql)
+        self.assertQuerysetEqual(unblocked, [yoko_post, paul_post, walrus_post])
+
+        # user querysets filtered any further fall back to IN, still without
+        # DISTINCT since a foreign key cannot repeat rows
+        not_yoko = self.john.relationships.following().exclude(pk=self.yoko.pk)
+        following = positive_filter(post_qs, not_yoko, 'author')
+        sql = str(following.query)
+        self.assertFalse('EXISTS' in sql)
+        self.assertFalse('DISTINCT' in sql)
+        self.assertQuerysetEqual(following, [paul_post])
+
+    def test_filters_use_id_querysets(self):
+        paul_post = Post.objects.create(author=self.paul)
+        yoko_post = Post.objects.create(author=self.yoko)
+        post_qs = Post.objects.all()
+
+        # the ids are read from the relationship table when the lookup is not
+        # a foreign key, leaving the user table out of the subquery
+        for user_qs in (self.john.relationships.following(),
+                        self.john.relationships.following_ids()):
+            following = positive_filter(post_qs, user_qs, 'author__pk')
+            sql = str(following.query)
+            self.assertFalse('EXISTS' in sql)
+            self.assertFalse('auth_user' in sql)
+            self.assertQuerysetEqual(following, [yoko_post, paul_post])
+
+        following = positive_filter(post_qs, self.john.relationships.following_ids(), 'author')
+        self.assertTrue('EXISTS' in str(following.query))
+        self.assertQuerysetEqual(following, [yoko_post, paul_post])
+
+        not_blocked = negative_filter(post_qs, self.john.relationships.blockers_ids(), 'author__pk')
+        self.assertQuerysetEqual(not_blocked, [yoko_post])
+
+    def test_bulk_relationship_exists(self):
+        everyone = [self.walrus, self.john, self.paul, self.yoko]
+
+        self.assertEqual(bulk_relationship_exists(self.john, everyone, 'following'), set([3, 4]))
+        self.assertEqual(bulk_relationship_exists(self.john, everyone, 'followers'), set([4]))
+        self.assertEqual(bulk_relationship_exists(self.john, everyone, 'friends'), set([4]))
+        self.assertEqual(bulk_relationship_exists(self.paul, everyone, 'blocking'), set([2]))
+        self.assertEqual(bulk_relationship_exists(self.john, everyone, 'blockers'), set([3]))
+
     def test_relationship_exists(self):
         self.assertTrue(relationship_exists(self.john, self.yoko, 'following'))
         self.assertTrue(relationship_exists(self.john, self.yoko, 'followers'))
@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+
+# sent after a batch of relationships has been inserted without saving each
+# instance, i.e. by RelationshipManager.add_many().  ``edges`` is a list of
+# (from_user_id, to_user_id) tuples sharing the given status and site.
+relationships_added = Signal(providing_args=['edges', 'status', 'site_id'])
+
+# sent after a batch of relationships has been deleted without loading each
+# instance, i.e. by RelationshipManager.remove(), in place of pre_delete and
+# post_delete.  Takes the same arguments as relationships_added.
+relationships_removed = Signal(providing_args=['edges', 'status', 'site_id'])
+
+# sent for every relationship that is created, deleted or changes status, by
+# the backend configured with RELATIONSHIPS_EVENT_BACKEND, once the change has
+# been committed.  ``event`` is a RelationshipEvent.
+relationship_event = Signal(providing_args=['event'])
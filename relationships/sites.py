@@ -0,0 +1,23 @@
+import threading
+
+from django.conf import settings
+
+
+_local = threading.local()
+
+
+def get_current_site_id():
+    """
+    Returns the id of the site relationships are scoped to: the one set for
+    the current thread by :func:`set_current_site_id`, if any, otherwise
+    ``settings.SITE_ID``.
+    """
+    return getattr(_local, 'site_id', None) or settings.SITE_ID
+
+
+def set_current_site_id(site_id):
+    _local.site_id = site_id
+
+
+def clear_current_site_id():
+    _local.__dict__.pop('site_id', None)
@@ -0,0 +1,228 @@
+"""
+Snapshots of the relationship graph in compressed sparse row (CSR) form, for
+offline analysis without touching the database.
+
+A snapshot holds the relationships of one status on one site, either from
+each user or, when reversed, to each user.  The file is a header followed by
+two little-endian arrays which can be memory-mapped:
+
+* ``offsets``, ``num_nodes + 1`` signed 64 bit integers.  The users followed
+  by the user with id ``n`` are ``neighbours[offsets[n]:offsets[n + 1]]``.
+* ``neighbours``, ``num_edges`` unsigned 32 bit user ids, sorted for each user.
+"""
+import datetime
+import mmap
+import os
+import shutil
+import struct
+from bisect import bisect_left
+
+from django.db import connection
+
+from .compat import atomic
+from .models import Relationship
+
+
+MAGIC = b'RELCSR01'
+
+# magic, status id, site id, watermark, number of nodes, number of edges
+HEADER = struct.Struct('<8sqqqqq')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_microseconds(dt):
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_microseconds(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def _write_array(f, code, values):
+    f.write(struct.pack('<%d%s' % (len(values), code), *values))
+
+
+def _edges_sql(reverse, after=False):
+    qn = connection.ops.quote_name
+    opts = Relationship._meta
+    user, other = 'from_user', 'to_user'
+    if reverse:
+        user, other = other, user
+    sql = 'SELECT %(user)s, %(other)s FROM %(table)s WHERE %(status)s = %%s AND %(site)s = %%s '
+    if after:
+        sql += 'AND (%(user)s > %%s OR (%(user)s = %%s AND %(other)s > %%s)) '
+    sql += 'ORDER BY %(user)s, %(other)s'
+    return sql % dict(
+        table=qn(opts.db_table),
+        user=qn(opts.get_field(user).column),
+        other=qn(opts.get_field(other).column),
+        status=qn(opts.get_field('status').column),
+        site=qn(opts.get_field('site').column),
+    )
+
+
+def _iter_edges(status_id, site_id, chunk_size, reverse):
+    if connection.vendor == 'postgresql':
+        # a named cursor keeps the results on the server, fetched in chunks.
+        # It is created on the driver's connection, which Django only opens
+        # with its first cursor, and must be read inside a transaction, which
+        # export_snapshot() opens
+        connection.cursor()
+        cursor = connection.connection.cursor(name='relationships_snapshot')
+        cursor.itersize = chunk_size
+        cursor.execute(_edges_sql(reverse), [status_id, site_id])
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+        return
+
+    # other drivers, MySQLdb's default cursor among them, read the whole
+    # result into memory, so page through the edges after the last one seen
+    cursor = connection.cursor()
+    sql = _edges_sql(reverse) + ' LIMIT %d' % chunk_size
+    params = [status_id, site_id]
+    try:
+        while True:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                break
+            user_id, other_id = rows[-1]
+            sql = _edges_sql(reverse, after=True) + ' LIMIT %d' % chunk_size
+            params = [status_id, site_id, user_id, user_id, other_id]
+    finally:
+        cursor.close()
+
+
+def export_snapshot(path, status, site_id, chunk_size=10000, reverse=False):
+    """
+    Writes the relationships with the given status and site to a snapshot at
+    ``path``, streaming them from the database ordered by an index so that
+    memory use does not grow with the size of the graph.  With
+    :param:`reverse` the snapshot lists the users with a relationship to
+    each user instead.  The file is replaced atomically once complete.
+    Returns the number of nodes and edges.
+
+    Relationships created from the time the export starts, its watermark,
+    may be missing from the snapshot.
+    """
+    return atomic(_export_snapshot)(path, getattr(status, 'pk', status), site_id,
+                                    chunk_size, reverse)
+
+
+def _export_snapshot(path, status_id, site_id, chunk_size, reverse):
+    watermark = _to_microseconds(datetime.datetime.now())
+    tmp_path = '%s.tmp' % path
+    neighbours_path = '%s.neighbours' % path
+
+    num_edges = 0
+    num_nodes = 0
+    offsets = []
+    neighbours = []
+
+    with open(tmp_path, 'wb') as out:
+        with open(neighbours_path, 'w+b') as neighbours_file:
+            out.write(HEADER.pack(MAGIC, status_id, site_id, watermark, 0, 0))
+
+            for user_id, other_id in _iter_edges(status_id, site_id, chunk_size, reverse):
+                while num_nodes <= user_id:
+                    offsets.append(num_edges)
+                    num_nodes += 1
+                neighbours.append(other_id)
+                num_edges += 1
+
+                if len(neighbours) >= chunk_size:
+                    _write_array(neighbours_file, 'I', neighbours)
+                    neighbours = []
+                if len(offsets) >= chunk_size:
+                    _write_array(out, 'q', offsets)
+                    offsets = []
+
+            offsets.append(num_edges)
+            _write_array(out, 'q', offsets)
+            _write_array(neighbours_file, 'I', neighbours)
+
+            neighbours_file.seek(0)
+            shutil.copyfileobj(neighbours_file, out)
+
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, status_id, site_id, watermark, num_nodes, num_edges))
+
+    os.remove(neighbours_path)
+    os.rename(tmp_path, path)
+    return num_nodes, num_edges
+
+
+class CSRSnapshot(object):
+    """
+    A snapshot written by :func:`export_snapshot`, memory-mapped so that
+    opening it costs the same whatever its size.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.status_id, self.site_id, watermark,
+         self.num_nodes, self.num_edges) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a relationship snapshot' % path)
+        self.watermark = _from_microseconds(watermark)
+        self._offsets = HEADER.size
+        self._neighbours = HEADER.size + 8 * (self.num_nodes + 1)
+
+    def _range(self, user_id):
+        if not 0 <= user_id < self.num_nodes:
+            return 0, 0
+        return struct.unpack_from('<qq', self._map, self._offsets + 8 * user_id)
+
+    def degree(self, user_id):
+        start, end = self._range(user_id)
+        return end - start
+
+    def neighbours(self, user_id):
+        """
+        Returns a tuple of the ids of the users the given user has a
+        relationship with (or from, for a reversed snapshot), in ascending
+        order.
+        """
+        start, end = self._range(user_id)
+        return struct.unpack_from('<%dI' % (end - start), self._map,
+                                  self._neighbours + 4 * start)
+
+    def has_edge(self, from_user_id, to_user_id):
+        neighbours = self.neighbours(from_user_id)
+        i = bisect_left(neighbours, to_user_id)
+        return i < len(neighbours) and neighbours[i] == to_user_id
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_snapshot(path):
+    return CSRSnapshot(path)
+
+
+def snapshot_filename(status, site_id, reverse=False):
+    """
+    The name under which ``export_relationship_snapshot`` writes a snapshot.
+    """
+    if reverse:
+        return '%s-%s.reverse.csr' % (status.from_slug, site_id)
+    return '%s-%s.csr' % (status.from_slug, site_id)
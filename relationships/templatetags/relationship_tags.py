@@ -4,10 +4,14 @@ from django.db.models.loading import get_model
 from django.template import TemplateSyntaxError
 from django.utils.functional import wraps
 from relationships.models import RelationshipStatus
-from relationships.utils import positive_filter, negative_filter
+from relationships.utils import (positive_filter, negative_filter,
+    bulk_relationship_exists)
 
 register = template.Library()
 
+# context variable holding the relationships loaded by prefetch_relationships
+PREFETCH_CONTEXT_KEY = '_prefetched_relationships'
+
 
 class IfRelationshipNode(template.Node):
     def __init__(self, nodelist_true, nodelist_false, *args):
@@ -23,6 +27,12 @@ class IfRelationshipNode(template.Node):
         if from_user.is_anonymous() or to_user.is_anonymous():
             return self.nodelist_false.render(context)
 
+        prefetched = context.get(PREFETCH_CONTEXT_KEY, {}).get((from_user.pk, self.status))
+        if prefetched and to_user.pk in prefetched[0]:
+            if to_user.pk in prefetched[1]:
+                return self.nodelist_true.render(context)
+            return self.nodelist_false.render(context)
+
         try:
             status = RelationshipStatus.objects.by_slug(self.status)
         except RelationshipStatus.DoesNotExist:
@@ -74,6 +84,61 @@ def if_relationship(parser, token):
     return IfRelationshipNode(nodelist_true, nodelist_false, *bits[1:])
 
 
+class PrefetchRelationshipsNode(template.Node):
+    def __init__(self, from_user, users, status):
+        self.from_user = from_user
+        self.users = users
+        self.status = status.replace('"', '')  # strip quotes
+
+    def render(self, context):
+        from_user = template.resolve_variable(self.from_user, context)
+        users = template.resolve_variable(self.users, context)
+
+        if from_user.is_anonymous():
+            return ''
+
+        user_ids = set(user.pk for user in users if user.pk is not None)
+
+        try:
+            found = bulk_relationship_exists(from_user, user_ids, self.status)
+        except RelationshipStatus.DoesNotExist:
+            raise template.TemplateSyntaxError('RelationshipStatus not found')
+
+        prefetched = context.get(PREFETCH_CONTEXT_KEY)
+        if prefetched is None:
+            prefetched = context[PREFETCH_CONTEXT_KEY] = {}
+
+        key = (from_user.pk, self.status)
+        checked, existing = prefetched.get(key, (set(), set()))
+        prefetched[key] = (checked | user_ids, (existing - user_ids) | found)
+        return ''
+
+
+@register.tag
+def prefetch_relationships(parser, token):
+    """
+    Load the relationships between a user and a list of users in bulk, so
+    that subsequent ``if_relationship`` tags for any of those users are
+    answered without touching the database.  Place it before the loop, at the
+    same level or above it.
+
+    Example::
+
+        {% prefetch_relationships request.user object_list "following" %}
+        {% for user in object_list %}
+            {% if_relationship request.user user "following" %}
+                unfollow
+            {% else %}
+                follow
+            {% endif_relationship %}
+        {% endfor %}
+    """
+    bits = list(token.split_contents())
+    if len(bits) != 4:
+        raise TemplateSyntaxError("%r takes 3 arguments:\n%s" % (bits[0], prefetch_relationships.__doc__))
+    return PrefetchRelationshipsNode(*bits[1:])
+
+
 @register.filter
 def add_relationship_url(user, status):
     """
@@ -106,13 +171,28 @@ def remove_relationship_url(user, status):
     return reverse('relationship_remove', args=[user.username, status])
 
 
+# "app_label.model" -> model class, for the models found so far
+_model_cache = {}
+
+
+def _get_content_qs(qs):
+    if isinstance(qs, basestring):
+        model = _model_cache.get(qs)
+        if model is None:
+            # misses are not remembered, the model may not be loaded yet
+            model = get_model(*qs.split('.'))
+            if model is None:
+                return None
+            _model_cache[qs] = model
+        qs = model._default_manager.all()
+    return qs
+
+
 def positive_filter_decorator(func):
     def inner(qs, user):
-        if isinstance(qs, basestring):
-            model = get_model(*qs.split('.'))
-            if not model:
-                return []
-            qs = model._default_manager.all()
+        qs = _get_content_qs(qs)
+        if qs is None:
+            return []
         if user.is_anonymous():
             return qs.none()
         return func(qs, user)
@@ -122,11 +202,9 @@ def positive_filter_decorator(func):
 
 def negative_filter_decorator(func):
     def inner(qs, user):
-        if isinstance(qs, basestring):
-            model = get_model(*qs.split('.'))
-            if not model:
-                return []
-            qs = model._default_manager.all()
+        qs = _get_content_qs(qs)
+        if qs is None:
+            return []
         if user.is_anonymous():
             return qs
         return func(qs, user)
@@ -1,5 +1,10 @@
+from django.conf import settings
+from django.db.models import ForeignKey, get_models
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.where import AND
+
 from .compat import User
-from .models import RelationshipStatus
+from .models import RelationshipStatus, RelationshipExists, relationship_ids
 
 
 def relationship_exists(from_user, to_user, status_slug='following'):
@@ -12,7 +17,34 @@ def relationship_exists(from_user, to_user, status_slug='following'):
         return from_user.relationships.exists(to_user, status, True)
 
 
-def extract_user_field(model):
+def bulk_relationship_exists(from_user, users, status_slug='following'):
+    """
+    Returns the set of ids of the given users for which
+    :func:`relationship_exists` would return ``True``, using at most two
+    queries regardless of the number of users.
+    """
+    status = RelationshipStatus.objects.by_slug(status_slug)
+    if status.from_slug == status_slug:
+        return from_user.relationships.bulk_exists(users, status)
+    elif status.to_slug == status_slug:
+        return from_user.relationships.bulk_related_to(users, status)
+    else:
+        return from_user.relationships.bulk_exists(users, status, True)
+
+
+# model class -> lookup of its user field, or None if it has none
+_user_field_cache = {}
+
+
+def _declared_user_field(model):
+    declared = getattr(settings, 'RELATIONSHIPS_USER_FIELDS', {})
+    key = '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+    if key in declared:
+        return declared[key]
+    return getattr(model, 'relationships_user_field', None)
+
+
+def _find_user_field(model):
     for field in model._meta.fields + model._meta.many_to_many:
         if field.rel and field.rel.to == User:
             return field.name
@@ -21,6 +53,80 @@ def extract_user_field(model):
             return rel.var_name
 
 
+def extract_user_field(model):
+    """
+    Returns the lookup used to filter instances of ``model`` by user.  It is
+    taken from the ``RELATIONSHIPS_USER_FIELDS`` setting, keyed by
+    ``'app_label.modelname'``, or a ``relationships_user_field`` attribute on
+    the model, and otherwise found by inspecting the model's fields.  The
+    result is remembered for every model.
+    """
+    try:
+        return _user_field_cache[model]
+    except KeyError:
+        user_field = _declared_user_field(model) or _find_user_field(model)
+        _user_field_cache[model] = user_field
+        return user_field
+
+
+def warm_user_field_cache():
+    """
+    Resolves the user field of every installed model up front, so that the
+    content filters never inspect models while serving a request.  Call it
+    once at startup, i.e. from your root ``urls.py``.
+    """
+    for model in get_models():
+        extract_user_field(model)
+
+
+def clear_user_field_cache():
+    _user_field_cache.clear()
+
+
+def _user_column(model, user_lookup):
+    """
+    Returns the column of the foreign key to User named by ``user_lookup``,
+    or ``None`` if the lookup follows any other kind of relation.
+    """
+    try:
+        field = model._meta.get_field(user_lookup)
+    except FieldDoesNotExist:
+        return None
+    if isinstance(field, ForeignKey) and field.rel.to == User and \
+            field.rel.get_related_field() == User._meta.pk:
+        return field.column
+
+
+def _filter_content(qs, user_qs, user_lookup, negated):
+    column = _user_column(qs.model, user_lookup)
+    relationship_filter = getattr(user_qs, '_relationship_filter', None)
+
+    if column and relationship_filter:
+        # test the relationship table directly with a correlated subquery
+        # keyed on the content's user column
+        qs = qs._clone()
+        qs.query.where.add(RelationshipExists(
+            qs.query.get_initial_alias(), column,
+            *relationship_filter, negated=negated
+        ), AND)
+        return qs
+
+    if relationship_filter:
+        # select the user ids from the relationship table alone rather than
+        # whole rows of the user table
+        user_qs = relationship_ids(*relationship_filter)
+
+    query = {'%s__in' % user_lookup: user_qs}
+    if negated:
+        qs = qs.exclude(**query)
+    else:
+        qs = qs.filter(**query)
+
+    if column:
+        return qs  # a foreign key cannot produce duplicate rows
+    return qs.distinct()
+
+
 def positive_filter(qs, user_qs, user_lookup=None):
     if not user_lookup:
         user_lookup = extract_user_field(qs.model)
@@ -28,9 +134,7 @@ def positive_filter(qs, user_qs, user_lookup=None):
     if not user_lookup:
         return qs.none()  # default to returning none
 
-    query = {'%s__in' % user_lookup: user_qs}
-
-    return qs.filter(**query).distinct()
+    return _filter_content(qs, user_qs, user_lookup, False)
 
 
 def negative_filter(qs, user_qs, user_lookup=None):
@@ -40,6 +144,4 @@ def negative_filter(qs, user_qs, user_lookup=None):
     if not user_lookup:
         return qs  # default to returning all
 
-    query = {'%s__in' % user_lookup: user_qs}
-
-    return qs.exclude(**query).distinct()
+    return _filter_content(qs, user_qs, user_lookup, True)
@@ -1,15 +1,20 @@
+import base64
+import datetime
 import json
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
+from django.db.models import Q
 from django.http import Http404, HttpResponseRedirect, HttpResponse
 from django.shortcuts import render
 from django.utils.http import urlquote
 from django.views.generic import ListView
 
+from .compat import StreamingHttpResponse
 from .decorators import require_user
-from .models import RelationshipStatus
+from .models import FROM, TO, Relationship, RelationshipStatus
+from .sites import get_current_site_id
 
 
 @login_required
@@ -26,6 +31,79 @@ def _relationship_list(request, queryset, template_name=None, *args, **kwargs):
     )(request, page=int(request.GET.get('page', 0)), *args, **kwargs)
 
 
+CURSOR_PAGE_SIZE = 20
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_cursor(relationship):
+    created = relationship.created
+    if getattr(settings, 'USE_TZ', False):
+        from django.utils.timezone import utc
+        created = created.astimezone(utc)
+    value = '%s|%s' % (created.strftime(CURSOR_DATETIME_FORMAT), relationship.pk)
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        created, pk = base64.urlsafe_b64decode(str(cursor)).decode('ascii').split('|')
+        created = datetime.datetime.strptime(created, CURSOR_DATETIME_FORMAT)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise Http404
+    if getattr(settings, 'USE_TZ', False):
+        from django.utils.timezone import utc
+        created = created.replace(tzinfo=utc)
+    return created, pk
+
+
+def _relationship_edges(user, status, status_slug):
+    """
+    Returns a queryset of the relationships described by the status slug,
+    along with the name of the field holding the other user.
+    """
+    if status.from_slug == status_slug:
+        return Relationship.objects.filter(
+            from_user=user, status=status, site=get_current_site_id()), 'to_user'
+    elif status.to_slug == status_slug:
+        return Relationship.objects.filter(
+            to_user=user, status=status, site=get_current_site_id()), 'from_user'
+    else:
+        reciprocated = Relationship.objects.filter(
+            to_user=user, status=status, site=get_current_site_id()
+        ).values('from_user')
+        return Relationship.objects.filter(
+            from_user=user, status=status, site=get_current_site_id(),
+            to_user__in=reciprocated), 'to_user'
+
+
+def _relationship_cursor_list(request, user, status, status_slug, template_name, extra_context):
+    """
+    Lists relationships newest first using keyset pagination on (created, id)
+    so that deep pages cost the same as the first one.  The ``cursor`` GET
+    parameter holds the opaque token found in ``next_cursor``.
+    """
+    edges, user_field = _relationship_edges(user, status, status_slug)
+
+    if request.GET['cursor']:
+        created, pk = _decode_cursor(request.GET['cursor'])
+        edges = edges.filter(
+            Q(created__lt=created) | Q(created=created, pk__lt=pk))
+
+    page = list(edges.select_related(user_field).order_by('-created', '-pk')[:CURSOR_PAGE_SIZE + 1])
+
+    next_cursor = None
+    if len(page) > CURSOR_PAGE_SIZE:
+        page = page[:CURSOR_PAGE_SIZE]
+        next_cursor = _encode_cursor(page[-1])
+
+    context = dict(extra_context,
+        relationship_list=[getattr(relationship, user_field) for relationship in page],
+        next_cursor=next_cursor,
+    )
+    return render(request, template_name, context)
+
+
 def get_relationship_status_or_404(status_slug):
     try:
         return RelationshipStatus.objects.by_slug(status_slug)
@@ -52,6 +130,15 @@ def relationship_list(request, user, status_slug=None,
     if status.private and not request.user == user:
         raise Http404
 
+    ec = dict(
+        from_user=user,
+        status=status,
+        status_slug=status_slug,
+    )
+
+    if 'cursor' in request.GET:
+        return _relationship_cursor_list(request, user, status, status_slug, template_name, ec)
+
     # get a queryset of users described by this relationship
     if status.from_slug == status_slug:
         qs = user.relationships.get_relationships(status=status)
@@ -60,12 +147,6 @@ def relationship_list(request, user, status_slug=None,
     else:
         qs = user.relationships.get_relationships(status=status, symmetrical=True)
 
-    ec = dict(
-        from_user=user,
-        status=status,
-        status_slug=status_slug,
-    )
-
     return _relationship_list(request, qs, template_name, extra_context=ec)
 
 
@@ -96,3 +177,42 @@ def relationship_handler(request, user, status_slug, add=True,
     return render(request,
         template_name,
         {'to_user': user, 'status': status, 'add': add})
+
+
+def _export_lines(user, directions, statuses):
+    for direction in directions:
+        for from_user_id, to_user_id, status_id, created in \
+                user.relationships.iter_edges(direction, statuses):
+            yield json.dumps({
+                'from_user': from_user_id,
+                'to_user': to_user_id,
+                'status': RelationshipStatus.objects.get_cached(status_id).from_slug,
+                'created': created.isoformat(),
+            }) + '\n'
+
+
+@login_required
+@require_user
+def relationship_export(request, user):
+    """
+    Streams every relationship from and to a user as JSON objects, one per
+    line, with users given by id.  Only the user and staff may export them.
+    The ``direction`` (``from`` or ``to``) and ``status`` (any number of
+    status slugs) GET parameters narrow the export down.
+    """
+    if request.user != user and not request.user.is_staff:
+        raise Http404
+
+    directions = [FROM, TO]
+    if request.GET.get('direction') in directions:
+        directions = [request.GET['direction']]
+
+    statuses = None
+    if request.GET.getlist('status'):
+        statuses = [get_relationship_status_or_404(status_slug)
+                    for status_slug in request.GET.getlist('status')]
+
+    response = StreamingHttpResponse(_export_lines(user, directions, statuses),
+                                     content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename=%s-relationships.jsonl' % user.username
+    return response
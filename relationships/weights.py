@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.db.models import F, Max, Min
+from django.utils import timezone
+from django.utils.importlib import import_module
+
+from .models import Relationship
+
+
+def exponential_decay(days):
+    """
+    The default decay function: returns the multiplier which halves a weight
+    every ``RELATIONSHIPS_DECAY_HALF_LIFE`` days (30 by default).
+    """
+    half_life = getattr(settings, 'RELATIONSHIPS_DECAY_HALF_LIFE', 30)
+    return 0.5 ** (float(days) / half_life)
+
+
+def get_decay_function():
+    """
+    Returns the function named by ``RELATIONSHIPS_DECAY_FUNCTION``, which is
+    given a number of days and returns the multiplier to apply to weights.
+    """
+    path = getattr(settings, 'RELATIONSHIPS_DECAY_FUNCTION', None)
+    if not path:
+        return exponential_decay
+    module, attr = path.rsplit('.', 1)
+    return getattr(import_module(module), attr)
+
+
+def user_id_range():
+    """
+    Returns the lowest and highest from_user id in the relationship table,
+    read from the unique index.
+    """
+    bounds = Relationship.objects.aggregate(low=Min('from_user'), high=Max('from_user'))
+    return bounds['low'], bounds['high']
+
+
+def iter_decay_weights(multiplier, start_user_id, end_user_id, chunk_size=1000, before=None):
+    """
+    Multiplies the weight of every relationship from users with ids from
+    ``start_user_id`` up to and including ``end_user_id`` by ``multiplier``,
+    with one ``UPDATE`` per ``chunk_size`` consecutive user ids, each
+    committed on its own so that no lock is held for long.  Only relationships
+    created before ``before`` (by default, now) are changed.
+
+    ``before`` also identifies the run: it is stored as the relationships'
+    ``last_decayed`` time and those already decayed by the run are skipped,
+    so a chunk repeated after a crash is not decayed twice.
+
+    Yields the id of the first user of the next chunk and the number of
+    relationships updated after every chunk, so that a caller can record its
+    progress and resume from there.
+    """
+    if before is None:
+        before = timezone.now()
+
+    for low in range(start_user_id, end_user_id + 1, chunk_size):
+        high = min(low + chunk_size, end_user_id + 1)
+        updated = Relationship.objects.filter(
+            from_user__gte=low,
+            from_user__lt=high,
+            created__lt=before,
+        ).exclude(
+            last_decayed=before,
+        ).update(weight=F('weight') * multiplier, last_decayed=before)
+        yield high, updated
+
+
+def decay_weights(days=1, chunk_size=1000):
+    """
+    Decays the weight of every relationship by the configured decay function
+    for the given number of days, i.e. from a nightly job.  Returns the number
+    of relationships updated.
+    """
+    low, high = user_id_range()
+    if low is None:
+        return 0
+    multiplier = get_decay_function()(days)
+    return sum(updated for next_user_id, updated in
+               iter_decay_weights(multiplier, low, high, chunk_size))